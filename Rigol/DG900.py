@@ -1,37 +1,31 @@
 import datetime
-import time
-import pyvisa as visa
-import logging
-from Rigol.rigol_util import val_and_unit_to_real_val, CustomLogger
-
-
-class _RigolDG900:
-
-    # Constructor
-    def __init__(self, resource, loglevel=logging.INFO):
-        self.logger = CustomLogger(self.__class__.__name__, loglevel)
-
-        try:
-            resources = visa.ResourceManager('@py')
-            self.device = resources.open_resource(resource)
-        except visa.Error as error:
-            self.logger.critical(error.description)
-            exit(-1)
-
-    def send_command(self, command):
-        self.logger.debug(f'Sent command: {command}')
-        self.device.write(command)
-
-    def read_response(self):
-        buffer = self.device.read_raw()
-        self.logger.debug(f'Got response: {buffer}')
-        return buffer
+from Rigol.rigol_util import val_and_unit_to_real_val
+from Rigol.rigol_instrument import _RigolInstrument, batched, exclusive
+
+
+class _RigolDG900(_RigolInstrument):
+
+    # :APPL sets frequency, amplitude, offset and phase at once, with coupling enabled a
+    # setting of one source also changes the other one
+    def _shadow_dependents(self, header):
+        if header.startswith(':COUP'):
+            return [':SOUR']
+        if not header.startswith(':SOUR'):
+            return []
+        source, _, path = header[len(':SOUR'):].partition(':')
+        if path.startswith('APPL'):
+            dependents = [f':SOUR{source}:']
+        else:
+            dependents = [f':SOUR{source}:APPL']
+        if self._coupling_enabled():
+            for other in ('1', '2'):
+                if other != source:
+                    dependents += [f':SOUR{other}:{path}', f':SOUR{other}:APPL']
+        return dependents
 
-    def query_command(self, command):
-        buffer = self.device.query(command)
-        filtered_buffer = buffer.replace("\n", "\\n")
-        self.logger.debug(f'Query sent: {command}, got: {filtered_buffer}')
-        return buffer
+    def _coupling_enabled(self):
+        return any(header.startswith(':COUP') and value.upper() in ('1', 'ON')
+                   for header, value in self._shadow.items())
 
     def getClassVars(self, cl):
         return [val for key, val in cl.__dict__.items() if not key.startswith('__') and not callable(val)]
@@ -41,21 +35,14 @@ class _RigolDG900:
 
     # CONSTANTS
 
-    class loglevel:
-        INFO = logging.INFO
-        WARNING = logging.WARNING
-        ERROR = logging.ERROR
-        CRITICAL = logging.CRITICAL
-        DEBUG = logging.DEBUG
-
     class scale:
         LINEAR = "LIN"
         LOGARITHMIC = "LOG"
         STEP = "STE"
 
     class trigger:
-        INTERNAL = "INT",
-        EXTERNAL = "EXT",
+        INTERNAL = "INT"
+        EXTERNAL = "EXT"
         MANUAL = "MAN"
 
     class waveform:
@@ -228,7 +215,7 @@ class _RigolDG900:
         INVERTED = "INV"
 
     class slope:
-        POSITIVE = "POS",
+        POSITIVE = "POS"
         NEGATIVE = "NEG"
 
     generic_function_list = [waveform.NOISE, waveform.RS232, waveform.DC, waveform.DUALTONE, waveform.PRBS, waveform.HARMONIC,
@@ -236,6 +223,7 @@ class _RigolDG900:
 
     # OUTPUT
 
+    @batched
     def setup_output(self, channel=1, impedance=limit.INFINITY, polarity=polarity.NORMAL):
         self.send_command(':OUTP' + str(channel) + ':IMP ' + str(impedance))
         self.send_command(':OUTP' + str(channel) + ':POL ' + str(polarity))
@@ -252,6 +240,7 @@ class _RigolDG900:
 
     # SOURCE
 
+    @batched
     def setup_source(self, source=1, shape=waveform.SINUSOID, frequency='1Hz', amplitude='5Vpp', offset='0V', duty=50.0, period='0ms', phase='0.0deg', freq_prbs='2kbps', sample_rate='2kbps'):
         match(shape):
             case self.waveform.NOISE | self.waveform.RS232:
@@ -294,38 +283,29 @@ class _RigolDG900:
             self.send_command(':SOUR' + str(source) + ':FUNC:SQU:DCYC ' +
                               str(val_and_unit_to_real_val(duty)))
 
+    @batched
     def setSweep(self, source=1, state=1, starting_frequency=0, stop_frequency=0, center_frequency=0, frequency_span=0, sweep_time=0, return_time=0, scale_type=scale.LINEAR, steps=0, trigger_source=trigger.INTERNAL, trigger_slope=slope.POSITIVE):
         self.send_command(f':SOUR{source}:SWE:STAT {state}')
-        time.sleep(0.1)
         if starting_frequency and stop_frequency:
             self.send_command(
                 f':SOUR{source}:FREQ:STAR {starting_frequency}')
-            time.sleep(0.1)
             self.send_command(f':SOUR{source}:FREQ:STOP {stop_frequency}')
-            time.sleep(0.1)
         elif center_frequency and frequency_span:
             self.send_command(f':SOUR{source}:FREQ:CENT {center_frequency}')
-            time.sleep(0.1)
             self.send_command(f':SOUR{source}:FREQ:SPAN {frequency_span}')
-            time.sleep(0.1)
         if return_time:
             self.send_command(f':SOUR{source}:SWE:RTIM {return_time}')
-            time.sleep(0.1)
         if sweep_time:
             self.send_command(f':SOUR{source}:SWE:TIME {sweep_time}')
-            time.sleep(0.1)
         if steps:
             self.send_command(f':SOUR{source}:SWE:STEP {steps}')
-            time.sleep(0.1)
 
         self.send_command(f':SOUR{source}:SWE:TRIG:SOUR {trigger_source}')
-        time.sleep(0.1)
         if trigger_source == self.trigger.EXTERNAL:
             self.send_command(f':SOUR{source}:SWE:TRIG:SLOP {trigger_slope}')
-            time.sleep(0.1)
 
         self.send_command(f':SOUR{source}:SWE:SPAC {scale_type}')
-        time.sleep(0.1)
+        self.wait_operation_complete(check_errors=True)
 
     def triggerSweep(self, source=1):
         # self.fgen.write(f':SOUR{source}:SWE:TRIG') # not working for me
@@ -340,6 +320,7 @@ class _RigolDG900:
         self.logger.info(
             f'Source set up NUMBER: {source}, FREQUENCY: {frequency}')
 
+    @batched
     def setVoltage(self, source=1, amplitude='1V', offset='0V'):
         self.send_command(
             f':SOUR{source}:VOLT:OFFS {offset}'.format(source, offset))
@@ -436,17 +417,18 @@ class _RigolDG900:
     # SYSTEM
 
     def close(self):
-        self.device.close()
+        super().close()
         self.logger.info("Closed USB session to fgen")
 
     def reset(self):
         self.send_command('*RST')
         self.logger.warning("Reset fgen")
-        time.sleep(4)
+        self.wait_operation_complete(timeout=self.reset_timeout)
 
     def beep(self):
         self.send_command(':SYST:BEEP:IMM')
 
+    @exclusive
     def write_screen_capture(self, filename=''):
         self.send_command(':HCOP:SDUM:DATA:FORM PNG')
         self.send_command(':HCOP:SDUM:DATA?')
@@ -460,8 +442,8 @@ class _RigolDG900:
         fid.close()
         self.logger.info("Wrote screen capture to filename " +
                          '\"' + filename + '\"')
-        time.sleep(5)
 
+    @exclusive
     def print_info(self):
         self.send_command('*IDN?')
         fullreading = self.read_response()
@@ -1,53 +1,50 @@
-import pyvisa as visa
 import datetime
 import time
 import numpy as np
 import logging
+import weakref
 from rich.progress import track
-from Rigol.rigol_util import eng_notation, val_and_unit_to_real_val, CustomLogger
+from Rigol.rigol_util import eng_notation, val_and_unit_to_real_val
+from Rigol.rigol_instrument import _RigolInstrument, batched, exclusive
+from Rigol.waveform import WaveformPreamble, scale_lut, scale_uint8, window_indices, window_preamble
+from Rigol.measure import measure_waveform
+from Rigol.transfer import read_block_into, parse_block_header, transport_from_resource, TransferPlanner, \
+    TransferProgress, PartialDownload
+from Rigol.pool import CONNECTION_ERRORS
 
 
-class _RigolDS1000:
+class _RigolDS1000(_RigolInstrument):
 
     # Constructor
-    def __init__(self, resource, loglevel=logging.INFO):
-        self.logger = CustomLogger(self.__class__.__name__, loglevel)
-
-        try:
-            resources = visa.ResourceManager('@py')
-            self.device = resources.open_resource(resource)
-        except visa.Error as error:
-            self.logger.critical(error.description)
-            exit(-1)
-
-    def send_command(self, command):
-        self.logger.debug(f'Sent command: {command}')
-        self.device.write(command)
-
-    def read_response(self):
-        buffer = self.device.read_raw()
-        self.logger.debug(f'Got response: {buffer}')
-        return buffer
-
-    def query_command(self, command):
-        buffer = self.device.query(command)
-        filtered_buffer = buffer.replace("\n", "\\n")
-        self.logger.debug(f'Query sent: {command}, got: {filtered_buffer}')
-        return buffer
-
-    class loglevel:
-        INFO = logging.INFO
-        WARNING = logging.WARNING
-        ERROR = logging.ERROR
-        CRITICAL = logging.CRITICAL
-        DEBUG = logging.DEBUG
-
+    def __init__(self, resource, loglevel=logging.INFO, shadow=False, device=None):
+        super().__init__(resource, loglevel, shadow, device)
+        self.transport = transport_from_resource(resource)
+        # chunk size per waveform format, tuned by the previous transfers
+        self._chunk_points = {}
+        # :WAV:PRE? per (channel, mode) and of every array handed out by a download
+        self._preambles = {}
+        self._data_preambles = {}
+
+    # reads an IEEE 488.2 block response straight into the preallocated buffer out
+    def read_block_response_into(self, out):
+        length = read_block_into(self.device, out)
+        self.logger.debug(f'Got block response of {length} bytes')
+        return length
+
+    # the scope clamps the offsets when scales change and rescales with the probe ratio
+    def _shadow_dependents(self, header):
+        if header.endswith(':PROB'):
+            return [header[:-len('PROB')] + 'SCAL', header[:-len('PROB')] + 'OFFS']
+        if header.endswith(':SCAL'):
+            return [header[:-len('SCAL')] + 'OFFS']
+        return []
+
+    @exclusive
     def print_info(self):
         self.send_command('*IDN?')
         fullreading = self.read_response()
         readinglines = fullreading.splitlines()
         self.logger.info("Scope information: {0}".format(readinglines[0]))
-        time.sleep(2)
 
     class measurement:
         def __init__(self, name='', description='', command='', unit='', return_type=''):
@@ -143,13 +140,26 @@ class _RigolDS1000:
     double_measurement_list = [
         rising_phase_ratio, falling_phase_ratio, rising_delay_time, falling_delay_time]
 
+    # item and its source(s) as :MEAS commands expect them, e.g. VPP,CHAN1
+    def _measurement_item(self, meas_type, channel, channel_compare):
+        if meas_type in self.double_measurement_list:
+            return meas_type.command + ',CHAN' + str(channel) + ',CHAN' + str(channel_compare)
+        return meas_type.command + ',CHAN' + str(channel)
+
+    def _measurement_query(self, meas_type, channel, channel_compare):
+        return ':MEAS:ITEM? ' + self._measurement_item(meas_type, channel, channel_compare)
+
+    @staticmethod
+    def _parse_measurement(meas_type, reply):
+        if (meas_type.return_type == 'float'):
+            return float(reply)
+        elif (meas_type.return_type == 'int'):
+            return int(float(reply))
+        return str(reply)
+
+    @exclusive
     def get_measurement(self, channel=1, channel_compare=2, meas_type=max_voltage):
-        if meas_type == self.rising_phase_ratio or meas_type == self.falling_phase_ratio:
-            self.send_command(
-                ':MEAS:ITEM? ' + meas_type.command + ',CHAN' + str(channel) + ',CHAN' + str(channel_compare))
-        else:
-            self.send_command(
-                ':MEAS:ITEM? ' + meas_type.command + ',CHAN' + str(channel))
+        self.send_command(self._measurement_query(meas_type, channel, channel_compare))
         fullreading = self.read_response()
         readinglines = fullreading.splitlines()
         if (meas_type.return_type == 'float'):
@@ -172,7 +182,108 @@ class _RigolDS1000:
                              " value is " + reading + " " + meas_type.unit)
         return reading
 
+    # all :MEAS:ITEM? queries of items pipelined into as few program messages as possible and
+    # parsed in one pass. Items of double_measurement_list compare channel with channel_compare.
+    # Returns a dict keyed by measurement name, or with as_record=True a numpy record.
+    # Without items all of single_measurement_list are read
+    def get_measurements(self, channel=1, items=None, channel_compare=2, as_record=False):
+        items = self.single_measurement_list if items is None else items
+        replies = self.query_commands(
+            [self._measurement_query(item, channel, channel_compare) for item in items])
+        readings = {item.name: self._parse_measurement(item, reply)
+                    for item, reply in zip(items, replies)}
+        self.logger.info(f"Channel {channel}: read {len(readings)} measurements")
+        if not as_record:
+            return readings
+        return self._measurement_record(readings, items)
+
+    # readings of get_measurements as one numpy record with a field per item
+    @staticmethod
+    def _measurement_record(readings, items):
+        dtypes = {'float': np.float64, 'int': np.int64}
+        dtype = [(item.name, dtypes.get(item.return_type, 'U32')) for item in items]
+        return np.rec.array([tuple(readings[item.name] for item in items)], dtype=dtype)[0]
+
+    # the same items computed client side from one RAW capture of the whole memory instead of
+    # queried, see Rigol.measure. Pass waveforms and preambles as returned by get_waveforms
+    # to measure a capture already downloaded, otherwise the channel(s) are downloaded first
+    def compute_measurements(self, channel=1, items=None, channel_compare=2, waveforms=None, preambles=None):
+        items = self.single_measurement_list if items is None else items
+        compare = any(item in self.double_measurement_list for item in items)
+        if waveforms is None:
+            waveforms, preambles = self.get_waveforms([channel, channel_compare] if compare else [channel])
+        preambles = preambles or {}
+        preamble = preambles.get(channel) or self.preamble_of(waveforms[channel])
+        compare_data = compare_preamble = None
+        if compare:
+            compare_data = waveforms[channel_compare]
+            compare_preamble = preambles.get(channel_compare) or self.preamble_of(compare_data)
+        readings = measure_waveform(waveforms[channel], preamble, items, compare_data, compare_preamble)
+        self.logger.info(f"Channel {channel}: computed {len(readings)} measurements from {len(waveforms[channel])} points")
+        return readings
+
+    # STATISTICS
+
+    class statistic:
+        MAXIMUM = 'MAX'
+        MINIMUM = 'MIN'
+        CURRENT = 'CURR'
+        AVERAGE = 'AVER'
+        DEVIATION = 'DEV'
+
+    # the scope shows statistics for at most 5 measurement items at a time
+    max_statistic_items = 5
+
+    # mode is either EXTR (min/max) or DIFF (deviation) for the on screen statistics display
+    @batched
+    def setup_statistics(self, on=1, mode='EXTR'):
+        self.send_command(':MEAS:STAT:DISP ' + ('ON' if on == 1 else 'OFF'))
+        self.send_command(':MEAS:STAT:MODE ' + mode)
+
+    def reset_statistics(self):
+        self.send_command(':MEAS:STAT:RES')
+
+    def add_statistic_item(self, channel=1, channel_compare=2, meas_type=max_voltage):
+        self.send_command(':MEAS:STAT:ITEM ' +
+                          self._measurement_item(meas_type, channel, channel_compare))
+
+    def get_statistic(self, channel=1, channel_compare=2, meas_type=max_voltage, stat_type=statistic.AVERAGE):
+        reply = self.query_command(f':MEAS:STAT:ITEM? {stat_type},' +
+                                   self._measurement_item(meas_type, channel, channel_compare))
+        return float(reply)
+
+    # lets the scope accumulate statistics of items over the given number of single
+    # acquisitions and reads them all in one final round trip. Returns a dict keyed by
+    # measurement name with min, max, mean, stddev and count, where count is the number of
+    # acquisitions triggered here (the scope does not report its own count)
+    @exclusive
+    def get_statistics(self, channel=1, items=(peak_to_peak_voltage,), acquisitions=10, channel_compare=2, timeout=None):
+        if len(items) > self.max_statistic_items:
+            raise ValueError(
+                f'The scope keeps statistics for at most {self.max_statistic_items} items')
+        with self.batch():
+            self.setup_statistics(on=1)
+            for item in items:
+                self.add_statistic_item(channel, channel_compare, item)
+            self.reset_statistics()
+        for _ in range(acquisitions):
+            self.single_trigger()
+            self.wait_for_acquisition(timeout)
+        fields = {'min': self.statistic.MINIMUM, 'max': self.statistic.MAXIMUM,
+                  'mean': self.statistic.AVERAGE, 'stddev': self.statistic.DEVIATION}
+        queries = [f':MEAS:STAT:ITEM? {stat_type},' + self._measurement_item(item, channel, channel_compare)
+                   for item in items for stat_type in fields.values()]
+        replies = iter(self.query_commands(queries))
+        statistics = {}
+        for item in items:
+            statistics[item.name] = {field: float(next(replies)) for field in fields}
+            statistics[item.name]['count'] = acquisitions
+        self.logger.info(
+            f"Channel {channel}: statistics of {len(items)} measurements over {acquisitions} acquisitions")
+        return statistics
+
     # if no filename is provided, the timestamp will be the filename
+    @exclusive
     def write_screen_capture(self, filename=''):
         self.send_command(':DISP:DATA? ON,OFF,PNG')
         # strip off first 11 bytes
@@ -185,19 +296,21 @@ class _RigolDS1000:
         fid.close()
         self.logger.info("Wrote screen capture to filename " +
                          '\"' + filename + '\"')
-        time.sleep(5)
 
     def close(self):
-        self.device.close()
+        super().close()
         self.logger.info("Closed USB session to oscilloscope")
 
     def reset(self):
+        self.invalidate_preambles()
         self.send_command('*RST')
         self.logger.warning("Reset oscilloscope")
-        time.sleep(8)
+        self.wait_operation_complete(timeout=self.reset_timeout)
 
     # probe should either be 10.0 or 1.0, per the setting on the physical probe
+    @batched
     def setup_channel(self, channel=1, on=1, offset_divs=0.0, volts_per_div=1.0, probe=10.0):
+        self.invalidate_preambles(channel)
         if (on == 1):
             self.send_command(':CHAN' + str(channel) + ':DISP ' + 'ON')
             self.send_command(
@@ -212,20 +325,27 @@ class _RigolDS1000:
             self.send_command(':CHAN' + str(channel) + ':DISP OFF')
             self.logger.info("Turned off channel " + str(channel))
 
+    # vertical scale only, the offset in volts is kept
+    def setup_scale(self, channel=1, volts_per_div=1.0):
+        self.invalidate_preambles(channel)
+        self.send_command(f':CHAN{channel}:SCAL {volts_per_div}')
+        self.logger.info(f'CH{channel} set to {volts_per_div} volts/div')
+
     def get_scale(self, channel=1):
-        return float(self.device.query(f':CHAN{channel}:SCAL?'))
+        return self.query_setting(f':CHAN{channel}:SCAL', float)
 
     def get_y_inc(self):
-        return float(self.device.query(':WAV:YINC?'))
+        return float(self.query_command(':WAV:YINC?'))
 
     def get_y_origin(self):
-        return int(self.device.query(':WAV:YOR?'))
+        return int(self.query_command(':WAV:YOR?'))
 
     def get_y_ref(self):
-        return int(self.device.query(':WAV:YREF?'))
+        return int(self.query_command(':WAV:YREF?'))
 
-    # remember to always use lowercase time_per_div units, the regex look for lowercase
+    @batched
     def setup_timebase(self, time_per_div='1ms', delay='1ms'):
+        self.invalidate_preambles()
         time_per_div_real = val_and_unit_to_real_val(time_per_div)
         self.send_command(':TIM:MAIN:SCAL ' + str(time_per_div_real))
         self.logger.info("Timebase was set to " +
@@ -233,7 +353,7 @@ class _RigolDS1000:
         delay_real = val_and_unit_to_real_val(delay)
         self.send_command(':TIM:MAIN:OFFS ' + str(delay_real))
 
-    # remember to always use lowercase level units, the regex look for lowercase
+    @batched
     def setup_trigger(self, channel=1, slope_pos=1, level='100mv'):
         level_real = val_and_unit_to_real_val(level)
         self.send_command(':TRIG:EDG:SOUR CHAN' + str(channel))
@@ -252,6 +372,7 @@ class _RigolDS1000:
     # decode channel is either 1 or 2, only two decodes can be present at any time
     # use uppercase for encoding, valid choices are HEX, ASC, DEC, BIN, LINE
     # position_divs is the number of division (from bottom) to position the decode
+    @batched
     def setup_i2c_decode(self, decode_channel=1, on=1, sda_channel=1, scl_channel=2, encoding='HEX', position_divs=1.0):
         if (on == 0):
             self.send_command(
@@ -274,92 +395,362 @@ class _RigolDS1000:
             self.send_command(
                 ':DEC' + str(decode_channel) + ':IIC:ADDR RW')
 
+    # seconds single_trigger() waits for the scope to leave the STOP state of the previous
+    # acquisition, a status still reading STOP after that means the new one finished already
+    arm_timeout = 0.1
+
+    # arms a single acquisition and waits until it is armed (status WAIT, RUN or TD), so that
+    # wait_for_acquisition() cannot return on the STOP state of the previous acquisition
+    @batched
     def single_trigger(self):
         self.send_command(':SING')
-        time.sleep(0.1)
-
+        self.wait_operation_complete()
+        try:
+            self.poll_status(':TRIG:STAT?', lambda reply: reply != 'STOP', self.arm_timeout,
+                             interval=1e-3, max_interval=0.01)
+        except TimeoutError:
+            self.logger.debug('Trigger status stayed STOP, the acquisition finished already')
+
+    # trigger status is one of TD, WAIT, RUN, AUTO or STOP
+    def get_trigger_status(self):
+        return self.query_command(':TRIG:STAT?').strip()
+
+    # blocks until the armed acquisition has finished (:TRIG:STAT? reports STOP), polling
+    # quickly at first and backing off for slow timebases. Raises TimeoutError after timeout
+    # seconds, by default sync_timeout
+    def wait_for_acquisition(self, timeout=None):
+        self.poll_status(':TRIG:STAT?', lambda reply: reply == 'STOP', timeout,
+                         interval=1e-3, max_interval=0.1)
+        self.logger.debug('Acquisition complete')
+
+    @batched
     def force_trigger(self):
         self.send_command(':TFOR')
-        time.sleep(0.1)
+        self.wait_operation_complete()
 
+    @batched
     def run_trigger(self):
         self.send_command(':RUN')
-        time.sleep(0.1)
-
-    # only allowed values are 6e3, 6e4, 6e5, 6e6, 12e6 for single channels
+        self.wait_operation_complete()
+
+    # chunk plan covering the points [first, last] of a :WAV:DATA? transfer, starting
+    # with the chunk size tuned during the previous transfer in the same format
+    def plan_transfer(self, last, first=1, fmt='BYTE'):
+        timeout = self.device.timeout
+        return TransferPlanner(last, first=first, fmt=fmt, transport=self.transport,
+                               timeout=timeout / 1000 if timeout else None,
+                               chunk_points=self._chunk_points.get(fmt))
+
+    # memory depths the scope accepts by the number of enabled channels, the sample memory
+    # is shared between the enabled channels
+    memory_depths = {1: (12e3, 12e4, 12e5, 12e6, 24e6),
+                     2: (6e3, 6e4, 6e5, 6e6, 12e6),
+                     3: (3e3, 3e4, 3e5, 3e6, 6e6),
+                     4: (3e3, 3e4, 3e5, 3e6, 6e6)}
+
+    def get_enabled_channels(self):
+        return [channel for channel in range(1, 5)
+                if self.query_setting(f':CHAN{channel}:DISP', lambda value: value in ('1', 'ON'))]
+
+    # memory depths allowed for the given number of enabled channels, by default the
+    # channels enabled on the scope
+    def allowed_memory_depths(self, channels=None):
+        if channels is None:
+            channels = len(self.get_enabled_channels())
+        if not 0 <= channels <= 4:
+            raise ValueError(f'The scope has 4 channels, got {channels}')
+        return self.memory_depths[max(channels, 1)]
+
+    # only allowed values are 12e3, 12e4, 12e5, 12e6, 24e6 for single channels
     # only allowed values are 6e3, 6e4, 6e5, 6e6, 12e6 for   dual channels
     # only allowed values are 3e3, 3e4, 3e5, 3e6, 6e6  for 3 or 4 channels
-    # the int conversion is needed for scientific notation values
-    def setup_mem_depth(self, memory_depth=12e6):
+    # channels is the number of channels that will be enabled during the acquisition, the
+    # channels enabled now when None. Without memory_depth the deepest allowed one is set,
+    # other values raise a ValueError instead of being ignored by the scope. The int
+    # conversion is needed for scientific notation values
+    @exclusive
+    def setup_mem_depth(self, memory_depth=None, channels=None):
+        allowed = self.allowed_memory_depths(channels)
+        if memory_depth is None:
+            memory_depth = max(allowed)
+        if int(memory_depth) not in [int(depth) for depth in allowed]:
+            raise ValueError(f'Memory depth {memory_depth:g} is not one of '
+                             f'{", ".join(f"{depth:g}" for depth in allowed)} for the enabled channels')
+        self.invalidate_preambles()
         self.send_command(':ACQ:MDEP ' + str(int(memory_depth)))
         self.logger.info(
             "Acquire memory depth set to {0} samples".format(memory_depth))
 
-    def get_waveform_data_ascii(self, channel=1, filename=''):
-        self.logger.info(
-            'WARNING: Ascii method is 8 times slower, try using the method "get_waveform_data_uint8()" in combination with "scale_waveform_uint8()"')
+    # stops the acquisition and selects RAW mode and format for :WAV:DATA?, returns the memory depth
+    @batched
+    def _setup_acquisition_download(self, fmt):
         self.send_command(':STOP')
-        self.send_command(f':WAV:SOUR CHAN{channel}')
-        time.sleep(1)
+        self.wait_operation_complete()
         self.send_command(':WAV:MODE RAW')
-        self.send_command(':WAV:FORM ASC')
+        self.send_command(f':WAV:FORM {fmt}')
         self.send_command(':ACQ:MDEP?')
         fullreading = self.read_response()
         readinglines = fullreading.splitlines()
-        mdepth = int(readinglines[0])
-        # transmission length can be higher (131072 instead of 15625) than rated in the documentation
-        num_reads = int((mdepth / 131072))
-        buffer = np.zeros(mdepth)
+        return int(readinglines[0])
 
-        #channel_adress_offset = num_reads * 131072 * (channel-1)
-
-        for i in track(range(0, num_reads), description="Downloading Waveform..."):
-            start = 1+i*131072
-            stop = (1+i)*131072
+    def _setup_waveform_download(self, channel, fmt):
+        mdepth = self._setup_acquisition_download(fmt)
+        self.send_command(f':WAV:SOUR CHAN{channel}')
+        return mdepth
+
+    # full :WAV:PRE? in one round trip. Per channel and waveform mode the preamble is cached
+    # until a setter changing the scaling (channel, timebase, memory depth) invalidates it,
+    # without a channel the current :WAV:SOUR is queried uncached
+    def get_preamble(self, channel=None, mode='RAW'):
+        if channel is None:
+            return WaveformPreamble.from_response(self.query_command(':WAV:PRE?'))
+        key = (channel, mode)
+        if key not in self._preambles:
+            with self.batch():
+                self.send_command(f':WAV:SOUR CHAN{channel}')
+                self.send_command(f':WAV:MODE {mode}')
+                self._preambles[key] = WaveformPreamble.from_response(
+                    self.query_command(':WAV:PRE?'))
+        return self._preambles[key]
+
+    def invalidate_preambles(self, channel=None):
+        if channel is None:
+            self._preambles.clear()
+        else:
+            for key in [key for key in self._preambles if key[0] == channel]:
+                del self._preambles[key]
+
+    # remembers the preamble a downloaded array has to be scaled with, for as long as the array lives
+    def _attach_preamble(self, data, preamble):
+        key = id(data)
+        self._data_preambles[key] = (
+            weakref.ref(data, lambda _: self._data_preambles.pop(key, None)), preamble)
+
+    # preamble of an array returned by one of the download methods, None for unknown arrays
+    def preamble_of(self, data):
+        entry = self._data_preambles.get(id(data))
+        if entry is not None and entry[0]() is data:
+            return entry[1]
+        return None
+
+    @exclusive
+    def get_waveform_data_ascii(self, channel=1, filename=''):
+        self.logger.info(
+            'WARNING: Ascii method is 8 times slower, try using the method "get_waveform_data_uint8()" in combination with "scale_waveform_uint8()"')
+        mdepth = self._setup_waveform_download(channel, fmt='ASC')
+        buffer = np.zeros(mdepth)
 
-            self.send_command(f':WAV:STAR {start}')
-            self.send_command(f':WAV:STOP {stop}')
-            self.send_command(':WAV:DATA?')
+        planner = self.plan_transfer(mdepth, fmt='ASC')
+        for start, stop in track(planner, total=planner.reads, description="Downloading Waveform..."):
+            t0 = time.perf_counter()
+            with self.batch():
+                self.send_command(f':WAV:STAR {start}')
+                self.send_command(f':WAV:STOP {stop}')
+                self.send_command(':WAV:DATA?')
             fullreading = self.read_response()
-            array = fullreading[11:-1]
+            planner.record(stop - start + 1, time.perf_counter() - t0)
+            header_length, length = parse_block_header(fullreading[:11])
+            array = fullreading[header_length:header_length+length]
             datapoints = np.fromstring(array, sep=',')
             buffer[start-1:stop] = datapoints
+        self._chunk_points['ASC'] = planner.chunk_points
 
         return buffer
 
-    def get_waveform_data_uint8(self, channel=1, filename=''):
-        self.send_command(':STOP')
-        self.send_command(f':WAV:SOUR CHAN{channel}')
-        time.sleep(1)
-        self.send_command(':WAV:MODE RAW')
-        self.send_command(':WAV:FORM BYTE')
-        self.send_command(':ACQ:MDEP?')
-        fullreading = self.read_response()
-        readinglines = fullreading.splitlines()
-        mdepth = int(readinglines[0])
-        num_reads = int((mdepth / 250000))
-        buffer = np.zeros(mdepth, dtype=np.uint8)
-
-        #channel_adress_offset = num_reads * 250000 * (channel-1)
-
-        for i in track(range(0, num_reads), description=f"Downloading Waveform Channel {channel}..."):
-            start = 1+i*250000
-            stop = (1+i)*250000
-            self.send_command(f':WAV:STAR {start}')
-            self.send_command(f':WAV:STOP {stop}')
-            self.send_command(':WAV:DATA?')
-            fullreading = self.read_response()
-            array = fullreading[11:-1]
-            datapoints = np.frombuffer(array, dtype=np.uint8)
-            buffer[start-1:stop] = datapoints
+    # times a failing :WAV:DATA? chunk is read again before the download gives up
+    chunk_retries = 3
+    # slowest transfer rate in points per second a retried chunk is given time for
+    min_transfer_rate = 50e3
+
+    # (start, stop, planner) chunks covering the missing ranges of progress, one planner per gap
+    def _plan_missing(self, progress, fmt):
+        for first, last in progress.missing():
+            planner = self.plan_transfer(last, first=first, fmt=fmt)
+            for start, stop in planner:
+                yield start, stop, planner
+            self._chunk_points[fmt] = planner.chunk_points
+
+    # reads the points [start, stop] into out. A read failing with a timeout, a lost session
+    # or a block of the wrong length is retried alone, after recovering the session and with
+    # a timeout scaled to the chunk size that grows with every attempt (unless the session
+    # has no timeout). The transfer time of the successful read is reported to planner
+    def _read_chunk_into(self, start, stop, out, planner=None):
+        timeout = self.device.timeout
+        timeout = timeout / 1000 if timeout else None
+        for attempt in range(self.chunk_retries + 1):
+            try:
+                t0 = time.perf_counter()
+                with self.io_timeout(timeout):
+                    with self.batch():
+                        self.send_command(f':WAV:STAR {start}')
+                        self.send_command(f':WAV:STOP {stop}')
+                        self.send_command(':WAV:DATA?')
+                    length = self.read_block_response_into(out)
+                if length != stop - start + 1:
+                    raise ValueError(f'Expected {stop - start + 1} points, the scope sent {length}')
+                if planner is not None:
+                    planner.record(stop - start + 1, time.perf_counter() - t0)
+                return length
+            except (*CONNECTION_ERRORS, ValueError) as error:
+                # a late block left in the session would be read as the reply to the next query
+                self.recover_session(error)
+                if attempt == self.chunk_retries:
+                    raise
+                self.logger.warning(f'Reading points {start} to {stop} failed ({error}), retrying')
+                if timeout is not None:
+                    timeout = max(timeout, (stop - start + 1) / self.min_transfer_rate) * 2
+
+    # downloads the RAW memory of the current :WAV:SOUR, setup has to be done already.
+    # Only the ranges progress (a TransferProgress or PartialDownload) misses are read
+    # into buffer, which defaults to a new array
+    def _download_uint8(self, mdepth, description, buffer=None, progress=None):
+        if buffer is None:
+            buffer = np.zeros(mdepth, dtype=np.uint8)
+        if progress is None:
+            progress = TransferProgress(mdepth)
+
+        # every chunk is read in place, the capture costs this single allocation
+        reads = sum(self.plan_transfer(last, first).reads for first, last in progress.missing())
+        for start, stop, planner in track(self._plan_missing(progress, 'BYTE'), total=reads, description=description):
+            self._read_chunk_into(start, stop, buffer[start-1:stop], planner)
+            progress.add(start, stop)
 
         return buffer
 
-    def scale_waveform_uint8(self, uint8_array):
-        inc = self.get_y_inc()
-        org = self.get_y_origin()
-        ref = self.get_y_ref()
-        return (np.array(uint8_array, dtype=np.float64) - org - ref) * inc
+    # points of an already received range read again before a partial download is resumed
+    resume_check_points = 1000
+
+    # True if the scope still holds the capture a partial download started with: the same
+    # settings (checked by PartialDownload) and the same points in a received range. A new
+    # acquisition of a perfectly repetitive signal cannot be told apart
+    def _partial_matches_capture(self, download):
+        start, stop = download.progress.ranges[0]
+        stop = min(stop, start + self.resume_check_points - 1)
+        check = np.empty(stop - start + 1, dtype=np.uint8)
+        self._read_chunk_into(start, stop, check)
+        return np.array_equal(check, download.buffer[start-1:stop])
+
+    # with partial set to a file path, the download progress is kept in that file (and a
+    # JSON sidecar) until the capture is complete. After an error the same call continues
+    # with the missing chunks, as long as the capture on the scope was not changed
+    @exclusive
+    def get_waveform_data_uint8(self, channel=1, filename='', partial=None):
+        mdepth = self._setup_waveform_download(channel, fmt='BYTE')
+        preamble = self.get_preamble(channel)
+        description = f"Downloading Waveform Channel {channel}..."
+        if partial is None:
+            buffer = self._download_uint8(mdepth, description)
+        else:
+            download = PartialDownload(partial, mdepth, {'channel': channel, 'preamble': preamble})
+            if download.progress.received and not self._partial_matches_capture(download):
+                self.logger.warning(f"{partial} belongs to an older capture, downloading from the start")
+                download.restart()
+            if download.progress.received:
+                self.logger.info(f"Resuming download with {download.progress.received} of {mdepth} points received")
+            self._download_uint8(mdepth, description, download.buffer, download)
+            buffer = download.finish()
+        self._attach_preamble(buffer, preamble)
+        return buffer
+
+    # downloads the RAW memory of several channels of the same acquisition, stopping and
+    # setting up the scope only once. Returns two dicts keyed by channel, the uint8 arrays
+    # and the WaveformPreamble needed to scale each of them
+    @exclusive
+    def get_waveforms(self, channels=(1, 2)):
+        mdepth = self._setup_acquisition_download(fmt='BYTE')
+        waveforms = {}
+        preambles = {}
+        for channel in channels:
+            self.send_command(f':WAV:SOUR CHAN{channel}')
+            preambles[channel] = self.get_preamble(channel)
+            waveforms[channel] = self._download_uint8(
+                mdepth, f"Downloading Waveform Channel {channel}...")
+            self._attach_preamble(waveforms[channel], preambles[channel])
+        return waveforms, preambles
+
+    # reads the displayed waveform (1200 points) of every channel, one :WAV:DATA? round trip each. Works
+    # without stopping the scope. Returns dicts of the uint8 points and preambles per channel
+    @exclusive
+    def get_screen_waveforms(self, channels=(1, 2)):
+        waveforms = {}
+        preambles = {}
+        for channel in channels:
+            preambles[channel] = self.get_preamble(channel, mode='NORM')
+            with self.batch():
+                self.send_command(f':WAV:SOUR CHAN{channel}')
+                self.send_command(':WAV:MODE NORM')
+                self.send_command(':WAV:FORM BYTE')
+                self.send_command(':WAV:DATA?')
+            data = np.empty(preambles[channel].points, dtype=np.uint8)
+            waveforms[channel] = data[:self.read_block_response_into(data)]
+            self._attach_preamble(waveforms[channel], preambles[channel])
+        return waveforms, preambles
+
+    # downloads only the points of the capture between t_start and t_stop (seconds relative
+    # to the trigger). With max_points the window is thinned to at most that many points:
+    # read from the screen data (NORM mode) if the window is on screen and the screen has
+    # enough points in it, otherwise every stride-th point of the RAW range is kept (the scope
+    # has no stride of its own). Returns the uint8 points and the WaveformPreamble to scale them
+    @exclusive
+    def get_waveform_window(self, channel, t_start, t_stop, max_points=None):
+        self._setup_waveform_download(channel, fmt='BYTE')
+        preamble = self.get_preamble(channel)
+        mode = 'RAW'
+        first, last = window_indices(preamble, t_start, t_stop)
+        if max_points is not None and last - first + 1 > max_points:
+            screen = self.get_preamble(channel, mode='NORM')
+            screen_end = screen.x_origin + (screen.points - screen.x_reference) * screen.x_increment
+            if screen.x_origin <= t_start and t_stop <= screen_end:
+                screen_first, screen_last = window_indices(screen, t_start, t_stop)
+                if screen_last - screen_first + 1 >= max_points:
+                    preamble, mode, first, last = screen, 'NORM', screen_first, screen_last
+        stride = 1 if max_points is None else max(-(-(last - first + 1) // max_points), 1)
+
+        self.send_command(f':WAV:MODE {mode}')
+        data = np.empty(last - first + 1, dtype=np.uint8)
+        for start, stop, planner in self._plan_missing(TransferProgress(last, first), 'BYTE'):
+            self._read_chunk_into(start, stop, data[start-first:stop-first+1], planner)
+        if stride > 1:
+            data = data[::stride].copy()
+        preamble = window_preamble(preamble, first, last, stride)
+        self.logger.info(f"Read {len(data)} points of channel {channel} from {t_start} s to {t_stop} s in {mode} mode")
+        self._attach_preamble(data, preamble)
+        return data, preamble
+
+    # yields (offset, chunk) while the RAW memory of the channel is downloaded, offset is the
+    # zero based index of the first point of the chunk within the capture. Peak memory is bounded by
+    # the chunk size: every chunk is a view into one reused buffer, copy it to keep it.
+    # With scaled=True the chunks hold volts in the given dtype instead of raw bytes.
+    # The instrument stays locked for other threads until the iteration ends or is closed.
+    def iter_waveform_chunks(self, channel=1, scaled=False, dtype=np.float32):
+        with self.transaction():
+            yield from self._iter_waveform_chunks(channel, scaled, dtype)
+
+    def _iter_waveform_chunks(self, channel, scaled, dtype):
+        mdepth = self._setup_waveform_download(channel, fmt='BYTE')
+        planner = self.plan_transfer(mdepth, fmt='BYTE')
+        raw = np.empty(planner.max_points, dtype=np.uint8)
+        if scaled:
+            lut = scale_lut(self.get_preamble(channel), dtype)
+            volts = np.empty(planner.max_points, dtype=dtype)
+        for start, stop in planner:
+            length = self._read_chunk_into(start, stop, raw, planner)
+            if scaled:
+                yield start-1, scale_uint8(raw[:length], None, out=volts, lut=lut)
+            else:
+                yield start-1, raw[:length]
+        self._chunk_points['BYTE'] = planner.chunk_points
+
+    # scales with the given preamble, the one cached for channel or the one the array was
+    # downloaded with, in this order. Only arrays of unknown origin cost :WAV:PRE? queries.
+    # Conversion is a single lookup table pass into out or a new array of the given dtype
+    def scale_waveform_uint8(self, uint8_array, preamble=None, channel=None, out=None, dtype=np.float32):
+        if preamble is None:
+            if channel is not None:
+                preamble = self.get_preamble(channel)
+            else:
+                preamble = self.preamble_of(uint8_array) or self.get_preamble()
+        return scale_uint8(uint8_array, preamble, out=out, dtype=dtype)
 
     # def write_waveform_data(self, channel=1, filename=''):
     #     self.oscilloscope.write(':WAV:SOUR: CHAN' + str(channel))
@@ -387,6 +778,7 @@ class _RigolDS1000:
     #         fid.write(reading[11:])
     #     fid.close()
 
+    @exclusive
     def write_scope_settings_to_file(self, filename=''):
         self.send_command(':SYST:SET?')
         # strip off first 11 bytes
@@ -400,7 +792,6 @@ class _RigolDS1000:
         fid.close()
         self.logger.info(
             "Wrote oscilloscope settings to filename " + '\"' + filename + '\"')
-        time.sleep(5)
 
     def restore_scope_settings_from_file(self, filename=''):
         if (filename == ''):
@@ -414,10 +805,12 @@ class _RigolDS1000:
                 # convert to a list that write_binary_values can iterate
                 for x in range(0, len(fileContent)-1):
                     valList.append(ord(fileContent[x]))
+                self.invalidate_preambles()
+                self.invalidate_shadow()
                 self.send_command_binary_values(
                     ':SYST:SET ', valList, datatype='B', is_big_endian=True)
             self.logger.info("Wrote oscilloscope settings to scope")
-            time.sleep(8)
+            self.wait_operation_complete(timeout=self.reset_timeout)
 
 
 class RigolDS1054Z(_RigolDS1000):
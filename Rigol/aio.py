@@ -0,0 +1,545 @@
+import asyncio
+import contextlib
+import datetime
+import logging
+import time
+import numpy as np
+from Rigol.DS1000 import _RigolDS1000
+from Rigol.DG900 import _RigolDG900
+from Rigol.waveform import WaveformPreamble, scale_lut, scale_uint8, window_indices, window_preamble
+from Rigol.transfer import parse_block_header, BLOCK_READ_SIZE
+
+# Asyncio counterparts of the drivers, talking raw SCPI over TCP (LAN port 5555).
+#
+# Commands are built by an instance of the blocking driver whose session is replaced by a
+# _CommandRecorder: a method that only writes (setters, triggers, reset, ...) runs
+# unchanged against the recorder and the recorded program messages are then sent on the
+# socket. Batching, the shadow cache and the preamble cache of the driver therefore work
+# the same way. Methods reading data from the instrument are implemented as coroutines.
+
+
+class _CommandRecorder:
+    # stands in for the VISA session while a blocking driver method runs. Synchronization
+    # queries are answered here and really awaited when the recording is replayed
+    replies = {'*OPC?': '1\n', '*ESR?': '0\n'}
+
+    def __init__(self):
+        self.messages = []
+        self.timeout = 10000
+
+    def write(self, message):
+        self.messages.append(message)
+
+    def query(self, message):
+        last = message.split(';')[-1]
+        if last not in self.replies:
+            raise RuntimeError(f'"{message}" needs a reply, use the coroutine of the async driver')
+        self.messages.append(message)
+        return self.replies[last]
+
+    def read_raw(self):
+        raise RuntimeError('Reading needs a coroutine of the async driver')
+
+    read_bytes = read_raw
+
+    def pop(self):
+        messages = self.messages
+        self.messages = []
+        return messages
+
+
+class _AsyncRigolInstrument:
+
+    driver_class = None
+
+    def __init__(self, host, port=5555, loglevel=logging.INFO, shadow=False):
+        self.host = host
+        self.port = port
+        self._recorder = _CommandRecorder()
+        self.driver = self.driver_class(f'TCPIP::{host}::{port}::SOCKET', loglevel, shadow,
+                                        device=self._recorder)
+        self.logger = self.driver.logger
+        self.timeout = self.driver.sync_timeout
+        self._reader = None
+        self._writer = None
+        # one transaction (write plus its replies) at a time on the connection
+        self._lock = asyncio.Lock()
+        # task holding _lock, see transaction()
+        self._owner = None
+
+    @classmethod
+    async def open(cls, host, port=5555, loglevel=logging.INFO, shadow=False):
+        instrument = cls(host, port, loglevel, shadow)
+        await instrument.connect()
+        return instrument
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self.logger.info(f'Connected to {self.host}:{self.port}')
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+        self.logger.info(f'Closed connection to {self.host}:{self.port}')
+
+    async def __aenter__(self):
+        if self._writer is None:
+            await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # every blocking driver method without own coroutine becomes a coroutine sending what
+    # the method would have sent, constants and measurement definitions are passed through
+    def __getattr__(self, name):
+        if name.startswith('_') or 'driver' not in self.__dict__:
+            raise AttributeError(name)
+        attribute = getattr(self.driver, name)
+        if not callable(attribute) or isinstance(attribute, type):
+            return attribute
+
+        async def replayed(*args, **kwargs):
+            async with self.transaction():
+                result, messages = self._record(attribute, *args, **kwargs)
+                await self._replay(messages)
+            return result
+        replayed.__name__ = name
+        return replayed
+
+    # holds the connection for a whole sequence of commands and the reads of their replies,
+    # like transaction() of the blocking driver. Transactions nest within one task
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        task = asyncio.current_task()
+        if self._owner is task:
+            yield
+            return
+        async with self._lock:
+            self._owner = task
+            try:
+                yield
+            finally:
+                self._owner = None
+
+    # runs a blocking driver method against the recorder and returns its result and the
+    # recorded messages. If it raises, the messages recorded so far are discarded
+    def _record(self, method, *args, **kwargs):
+        try:
+            return method(*args, **kwargs), self._recorder.pop()
+        finally:
+            self._recorder.pop()
+
+    # I/O
+
+    # message is a str or, for binary program data, bytes
+    async def _write(self, message):
+        self.logger.debug(f'Sent command: {message}')
+        self._writer.write((message if isinstance(message, bytes) else message.encode()) + b'\n')
+        await self._writer.drain()
+
+    async def _read_line(self, timeout=None):
+        line = await asyncio.wait_for(self._reader.readline(), timeout or self.timeout)
+        self.logger.debug(f'Got response: {line}')
+        return line
+
+    async def _replay(self, messages):
+        for message in messages:
+            await self._write(message)
+            if '?' in message:
+                # replies to synchronization queries arrive once the instrument is done
+                reply = (await self._read_line(self.driver.reset_timeout)).decode().strip()
+                if message.endswith('*ESR?'):
+                    self.driver._log_event_status(int(reply.split(';')[-1]))
+
+    async def send_command(self, command):
+        async with self.transaction():
+            _, messages = self._record(self.driver.send_command, command)
+            await self._replay([m for m in messages if '?' not in m])
+            if '?' in command:
+                await self._write(command)
+
+    async def read_response(self):
+        return await self._read_line()
+
+    async def query_command(self, command, timeout=None):
+        async with self.transaction():
+            return await self._query(command, timeout)
+
+    async def _query(self, command, timeout=None):
+        # messages recorded earlier (e.g. by a batch) go out before the query
+        await self._replay(self._recorder.pop())
+        await self._write(command)
+        return (await self._read_line(timeout)).decode()
+
+    # discards whatever arrives until the connection stays quiet, e.g. the late reply of a
+    # query that timed out
+    async def _drain(self, quiet=0.2):
+        while True:
+            try:
+                if not await asyncio.wait_for(self._reader.read(BLOCK_READ_SIZE), quiet):
+                    return
+            except asyncio.TimeoutError:
+                return
+
+    # reads the header of an IEEE 488.2 block response and returns the payload length
+    async def _read_block_length(self):
+        header = await self._reader.readexactly(2)
+        if header[0:1] == b'#' and header[1:2].isdigit():
+            header += await self._reader.readexactly(int(header[1:2]))
+        return parse_block_header(header)[1]
+
+    # reads a block response of unknown length
+    async def _read_block(self):
+        data = await self._reader.readexactly(await self._read_block_length())
+        await self._reader.readexactly(1)
+        return data
+
+    async def _write_screen_capture(self, command, filename):
+        async with self.transaction():
+            await self._write(command)
+            data = await asyncio.wait_for(self._read_block(), self.timeout)
+        if filename == '':
+            filename = "rigol_" + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".png"
+        with open(filename, 'wb') as fid:
+            fid.write(data)
+        self.logger.info(f'Wrote screen capture to filename "{filename}"')
+
+    async def query_setting(self, header, convert=str):
+        value = self.driver._confirmed_setting(header)
+        if value is None:
+            value = (await self.query_command(f'{header}?')).strip()
+            if self.driver._shadow is not None:
+                self.driver._shadow[header.upper()] = value
+                self.driver._shadow_confirmed.add(header.upper())
+        return convert(value)
+
+    async def query_commands(self, queries):
+        queries = list(queries)
+        replies = []
+        async with self.transaction():
+            for message in self.driver._pack_messages(queries):
+                expected = len(replies) + message.count('?')
+                replies += (await self.query_command(message)).strip().split(';')
+                while len(replies) < expected:
+                    replies += (await self.read_response()).decode().strip().split(';')
+        return replies
+
+    # SYNCHRONIZATION
+
+    async def poll_status(self, query, predicate, timeout=None, interval=1e-3, max_interval=0.1):
+        timeout = self.driver.sync_timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            async with self.transaction():
+                try:
+                    reply = (await self._query(
+                        query, max(deadline - loop.time(), self.driver.min_poll_io_timeout))).strip()
+                    if predicate(reply):
+                        return reply
+                except asyncio.TimeoutError:
+                    await self._drain()
+            if loop.time() >= deadline:
+                raise TimeoutError(f'{query} did not reach the expected state within {timeout} s')
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+    async def wait_operation_complete(self, timeout=None, check_errors=False):
+        await self.query_command('*OPC?', timeout or self.driver.sync_timeout)
+        if check_errors:
+            await self.check_event_status()
+
+    async def check_event_status(self):
+        esr = int(await self.query_command('*ESR?'))
+        self.driver._log_event_status(esr)
+        return esr
+
+    async def print_info(self):
+        reply = await self.query_command('*IDN?')
+        self.logger.info(f"Instrument information: {reply.strip()}")
+        return reply.strip()
+
+
+class AsyncRigolDS1000(_AsyncRigolInstrument):
+    driver_class = _RigolDS1000
+
+    async def get_measurement(self, channel=1, channel_compare=2, meas_type=_RigolDS1000.max_voltage):
+        reply = await self.query_command(
+            self.driver._measurement_query(meas_type, channel, channel_compare))
+        return self.driver._parse_measurement(meas_type, reply.strip())
+
+    async def get_measurements(self, channel=1, items=None, channel_compare=2, as_record=False):
+        items = self.driver.single_measurement_list if items is None else items
+        replies = await self.query_commands(
+            [self.driver._measurement_query(item, channel, channel_compare) for item in items])
+        readings = {item.name: self.driver._parse_measurement(item, reply)
+                    for item, reply in zip(items, replies)}
+        if not as_record:
+            return readings
+        return self.driver._measurement_record(readings, items)
+
+    async def compute_measurements(self, channel=1, items=None, channel_compare=2, waveforms=None, preambles=None):
+        items = self.driver.single_measurement_list if items is None else items
+        if waveforms is None:
+            compare = any(item in self.driver.double_measurement_list for item in items)
+            waveforms, preambles = await self.get_waveforms([channel, channel_compare] if compare else [channel])
+        return self.driver.compute_measurements(channel, items, channel_compare, waveforms, preambles)
+
+    async def get_statistic(self, channel=1, channel_compare=2, meas_type=_RigolDS1000.max_voltage,
+                            stat_type=_RigolDS1000.statistic.AVERAGE):
+        return float(await self.query_command(f':MEAS:STAT:ITEM? {stat_type},' +
+                                              self.driver._measurement_item(meas_type, channel, channel_compare)))
+
+    async def get_statistics(self, channel=1, items=(_RigolDS1000.peak_to_peak_voltage,), acquisitions=10,
+                             channel_compare=2, timeout=None):
+        if len(items) > self.driver.max_statistic_items:
+            raise ValueError(
+                f'The scope keeps statistics for at most {self.driver.max_statistic_items} items')
+        fields = {'min': self.driver.statistic.MINIMUM, 'max': self.driver.statistic.MAXIMUM,
+                  'mean': self.driver.statistic.AVERAGE, 'stddev': self.driver.statistic.DEVIATION}
+        async with self.transaction():
+            await self.setup_statistics(on=1)
+            for item in items:
+                await self.add_statistic_item(channel, channel_compare, item)
+            await self.reset_statistics()
+            for _ in range(acquisitions):
+                await self.single_trigger()
+                await self.wait_for_acquisition(timeout)
+            replies = iter(await self.query_commands(
+                [f':MEAS:STAT:ITEM? {stat_type},' + self.driver._measurement_item(item, channel, channel_compare)
+                 for item in items for stat_type in fields.values()]))
+        statistics = {}
+        for item in items:
+            statistics[item.name] = {field: float(next(replies)) for field in fields}
+            statistics[item.name]['count'] = acquisitions
+        return statistics
+
+    async def write_screen_capture(self, filename=''):
+        await self._write_screen_capture(':DISP:DATA? ON,OFF,PNG', filename)
+
+    async def get_scale(self, channel=1):
+        return await self.query_setting(f':CHAN{channel}:SCAL', float)
+
+    async def get_y_inc(self):
+        return float(await self.query_command(':WAV:YINC?'))
+
+    async def get_y_origin(self):
+        return int(await self.query_command(':WAV:YOR?'))
+
+    async def get_y_ref(self):
+        return int(await self.query_command(':WAV:YREF?'))
+
+    async def get_enabled_channels(self):
+        return [channel for channel in range(1, 5)
+                if await self.query_setting(f':CHAN{channel}:DISP', lambda value: value in ('1', 'ON'))]
+
+    async def allowed_memory_depths(self, channels=None):
+        if channels is None:
+            channels = len(await self.get_enabled_channels())
+        return self.driver.allowed_memory_depths(channels)
+
+    async def setup_mem_depth(self, memory_depth=None, channels=None):
+        if channels is None:
+            channels = len(await self.get_enabled_channels())
+        async with self.transaction():
+            _, messages = self._record(self.driver.setup_mem_depth, memory_depth, channels)
+            await self._replay(messages)
+
+    async def single_trigger(self):
+        await self.query_command(':SING;*OPC?')
+        try:
+            await self.poll_status(':TRIG:STAT?', lambda reply: reply != 'STOP', self.driver.arm_timeout,
+                                   interval=1e-3, max_interval=0.01)
+        except TimeoutError:
+            self.logger.debug('Trigger status stayed STOP, the acquisition finished already')
+
+    async def get_trigger_status(self):
+        return (await self.query_command(':TRIG:STAT?')).strip()
+
+    async def wait_for_acquisition(self, timeout=None):
+        await self.poll_status(':TRIG:STAT?', lambda reply: reply == 'STOP', timeout)
+
+    async def get_preamble(self, channel, mode='RAW'):
+        key = (channel, mode)
+        if key not in self.driver._preambles:
+            self.driver._preambles[key] = WaveformPreamble.from_response(await self.query_command(
+                f':WAV:SOUR CHAN{channel};:WAV:MODE {mode};:WAV:PRE?'))
+        return self.driver._preambles[key]
+
+    # WAVEFORMS
+
+    async def _setup_acquisition_download(self):
+        await self.query_command(':STOP;*OPC?')
+        return int(await self.query_command(':WAV:MODE RAW;:WAV:FORM BYTE;:ACQ:MDEP?'))
+
+    async def _read_block_into(self, out):
+        length = await self._read_block_length()
+        view = memoryview(out).cast('B')
+        if length > len(view):
+            raise ValueError(f'Block of {length} bytes does not fit into buffer of {len(view)} bytes')
+        pos = 0
+        while pos < length:
+            piece = await self._reader.readexactly(min(BLOCK_READ_SIZE, length - pos))
+            view[pos:pos + len(piece)] = piece
+            pos += len(piece)
+        await self._reader.readexactly(1)
+        return length
+
+    async def _read_chunk_into(self, start, stop, out, planner):
+        async with self.transaction():
+            t0 = time.perf_counter()
+            await self._write(f':WAV:STAR {start};:WAV:STOP {stop};:WAV:DATA?')
+            try:
+                length = await asyncio.wait_for(self._read_block_into(out), self.timeout)
+                if length != stop - start + 1:
+                    raise ValueError(f'Expected {stop - start + 1} points, the scope sent {length}')
+            except (asyncio.TimeoutError, ValueError):
+                # the rest of the block would be read as the reply to the next query
+                await self._drain()
+                raise
+            planner.record(stop - start + 1, time.perf_counter() - t0)
+            return length
+
+    # async counterpart of iter_waveform_chunks, yields (offset, chunk) views of a reused buffer.
+    # The connection stays locked for other tasks until the iteration ends or is closed
+    async def iter_waveform_chunks(self, channel=1, scaled=False, dtype=np.float32):
+        async with self.transaction():
+            mdepth = await self._setup_acquisition_download()
+            if scaled:
+                lut = scale_lut(await self.get_preamble(channel), dtype)
+            await self.query_command(f':WAV:SOUR CHAN{channel};*OPC?')
+            planner = self.driver.plan_transfer(mdepth, fmt='BYTE')
+            raw = np.empty(planner.max_points, dtype=np.uint8)
+            volts = np.empty(planner.max_points, dtype=dtype) if scaled else None
+            for start, stop in planner:
+                length = await self._read_chunk_into(start, stop, raw, planner)
+                if scaled:
+                    yield start-1, scale_uint8(raw[:length], None, out=volts, lut=lut)
+                else:
+                    yield start-1, raw[:length]
+            self.driver._chunk_points['BYTE'] = planner.chunk_points
+
+    async def _download_uint8(self, mdepth):
+        buffer = np.zeros(mdepth, dtype=np.uint8)
+        planner = self.driver.plan_transfer(mdepth, fmt='BYTE')
+        for start, stop in planner:
+            await self._read_chunk_into(start, stop, buffer[start-1:stop], planner)
+        self.driver._chunk_points['BYTE'] = planner.chunk_points
+        return buffer
+
+    # displayed waveform (1200 points) of every channel, without stopping the scope
+    async def get_screen_waveforms(self, channels=(1, 2)):
+        waveforms = {}
+        preambles = {}
+        async with self.transaction():
+            for channel in channels:
+                preambles[channel] = await self.get_preamble(channel, mode='NORM')
+                data = np.empty(preambles[channel].points, dtype=np.uint8)
+                await self._write(f':WAV:SOUR CHAN{channel};:WAV:MODE NORM;:WAV:FORM BYTE;:WAV:DATA?')
+                length = await asyncio.wait_for(self._read_block_into(data), self.timeout)
+                waveforms[channel] = data[:length]
+                self.driver._attach_preamble(waveforms[channel], preambles[channel])
+        return waveforms, preambles
+
+    async def get_waveform_data_uint8(self, channel=1):
+        waveforms, _ = await self.get_waveforms([channel])
+        return waveforms[channel]
+
+    # the connection is held from the setup until the last chunk of the last channel is read,
+    # so no other task can change the :WAV settings in between
+    async def get_waveforms(self, channels=(1, 2)):
+        waveforms = {}
+        preambles = {}
+        async with self.transaction():
+            mdepth = await self._setup_acquisition_download()
+            for channel in channels:
+                preambles[channel] = await self.get_preamble(channel)
+                await self.query_command(f':WAV:SOUR CHAN{channel};:WAV:MODE RAW;*OPC?')
+                waveforms[channel] = await self._download_uint8(mdepth)
+                self.driver._attach_preamble(waveforms[channel], preambles[channel])
+        return waveforms, preambles
+
+    async def get_waveform_window(self, channel, t_start, t_stop, max_points=None):
+        async with self.transaction():
+            await self._setup_acquisition_download()
+            await self.query_command(f':WAV:SOUR CHAN{channel};*OPC?')
+            preamble = await self.get_preamble(channel)
+            mode = 'RAW'
+            first, last = window_indices(preamble, t_start, t_stop)
+            if max_points is not None and last - first + 1 > max_points:
+                screen = await self.get_preamble(channel, mode='NORM')
+                screen_end = screen.x_origin + (screen.points - screen.x_reference) * screen.x_increment
+                if screen.x_origin <= t_start and t_stop <= screen_end:
+                    screen_first, screen_last = window_indices(screen, t_start, t_stop)
+                    if screen_last - screen_first + 1 >= max_points:
+                        preamble, mode, first, last = screen, 'NORM', screen_first, screen_last
+            stride = 1 if max_points is None else max(-(-(last - first + 1) // max_points), 1)
+
+            await self.query_command(f':WAV:MODE {mode};*OPC?')
+            data = np.empty(last - first + 1, dtype=np.uint8)
+            planner = self.driver.plan_transfer(last, first=first, fmt='BYTE')
+            for start, stop in planner:
+                await self._read_chunk_into(start, stop, data[start-first:stop-first+1], planner)
+            self.driver._chunk_points['BYTE'] = planner.chunk_points
+        if stride > 1:
+            data = data[::stride].copy()
+        preamble = window_preamble(preamble, first, last, stride)
+        self.logger.info(f"Read {len(data)} points of channel {channel} from {t_start} s to {t_stop} s in {mode} mode")
+        self.driver._attach_preamble(data, preamble)
+        return data, preamble
+
+    async def get_waveform_data_ascii(self, channel=1, filename=''):
+        self.logger.info(
+            'WARNING: Ascii method is 8 times slower, try using the method "get_waveform_data_uint8()" in combination with "scale_waveform_uint8()"')
+        async with self.transaction():
+            await self.query_command(':STOP;*OPC?')
+            mdepth = int(await self.query_command(f':WAV:MODE RAW;:WAV:FORM ASC;:WAV:SOUR CHAN{channel};:ACQ:MDEP?'))
+            buffer = np.zeros(mdepth)
+            planner = self.driver.plan_transfer(mdepth, fmt='ASC')
+            for start, stop in planner:
+                t0 = time.perf_counter()
+                await self._write(f':WAV:STAR {start};:WAV:STOP {stop};:WAV:DATA?')
+                datapoints = np.fromstring(
+                    (await asyncio.wait_for(self._read_block(), self.timeout)).decode(), sep=',')
+                planner.record(stop - start + 1, time.perf_counter() - t0)
+                buffer[start-1:stop] = datapoints
+            self.driver._chunk_points['ASC'] = planner.chunk_points
+        return buffer
+
+    async def write_scope_settings_to_file(self, filename=''):
+        async with self.transaction():
+            await self._write(':SYST:SET?')
+            data = await asyncio.wait_for(self._read_block(), self.timeout)
+        if filename == '':
+            filename = "rigol_settings_" + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".stp"
+        with open(filename, 'wb') as fid:
+            fid.write(data)
+        self.logger.info(f'Wrote oscilloscope settings to filename "{filename}"')
+
+    # sends the settings written by write_scope_settings_to_file as :SYST:SET block
+    async def restore_scope_settings_from_file(self, filename=''):
+        if filename == '':
+            self.logger.info("ERROR: must specify filename\n")
+            return
+        with open(filename, 'rb') as fid:
+            settings = fid.read()
+        self.driver.invalidate_preambles()
+        self.driver.invalidate_shadow()
+        async with self.transaction():
+            await self._write(b':SYST:SET #9' + f'{len(settings):09d}'.encode() + settings)
+
+    def scale_waveform_uint8(self, uint8_array, preamble=None, out=None, dtype=np.float32):
+        preamble = preamble or self.driver.preamble_of(uint8_array)
+        if preamble is None:
+            raise ValueError('Unknown array, pass the preamble it was downloaded with')
+        return scale_uint8(uint8_array, preamble, out=out, dtype=dtype)
+
+
+class AsyncRigolDG900(_AsyncRigolInstrument):
+    driver_class = _RigolDG900
+
+    async def write_screen_capture(self, filename=''):
+        await self._write_screen_capture(':HCOP:SDUM:DATA:FORM PNG;:HCOP:SDUM:DATA?', filename)
@@ -0,0 +1,319 @@
+import time
+from typing import NamedTuple
+import numpy as np
+from Rigol.waveform import scale_uint8
+from Rigol.measure import WaveformMeasurements
+
+# Gain and phase of a DUT against a reference channel at a known excitation frequency.
+#
+# Instead of the edge based on screen measurements of the scope (FREQ, VPP, FPH), both
+# channels of one NORM mode acquisition are downloaded and the complex amplitude of the
+# excitation tone is computed with a windowed single bin DFT (the vectorized equivalent of
+# the Goertzel algorithm). Everything not at the excitation frequency, noise, harmonics and
+# offsets included, is rejected by the window.
+#
+# Up to three DUTs can be measured against one reference at once (a channel map of the
+# four scope inputs): all channels come from the same acquisition and are demodulated in
+# one vectorized pass, the BodePoint fields then hold one entry per DUT.
+#
+# A swept sine capture (see analyze_sweep) is demodulated the same way, block by block,
+# with the instantaneous phase of the reference channel in place of a fixed frequency.
+
+
+# the fields of a BodePoint are arrays when it describes a curve (one entry per frequency)
+# or several DUTs (one entry per DUT, the last axis of the gain and phase of a curve)
+class BodePoint(NamedTuple):
+    frequency: float
+    gain: float  # linear, DUT amplitude / reference amplitude
+    phase: float  # degrees, DUT relative to the reference, within (-180, 180]
+    dut_amplitude: float  # peak volts
+    ref_amplitude: float  # peak volts
+
+    @property
+    def gain_db(self):
+        return 20 * np.log10(self.gain)
+
+
+def tone_phasors(volts, frequency, x_increment, window=np.hanning):
+    """Complex amplitude (peak volts and phase) of the tone at frequency in the last axis of volts.
+
+    volts can hold one waveform or a 2D array with one waveform per row, all sampled with
+    x_increment. The frequency does not have to fall on a DFT bin, the window (a numpy window
+    function of the length) suppresses the leakage of other frequencies and the DC offset.
+    """
+    volts = np.asarray(volts)
+    points = volts.shape[-1]
+    weights = window(points)
+    # removing the mean first keeps the leakage of large offsets out of short records
+    centered = volts - volts.mean(axis=-1, keepdims=True)
+    kernel = weights * np.exp(-2j * np.pi * frequency * x_increment * np.arange(points))
+    return 2 * (centered @ kernel) / weights.sum()
+
+
+def gain_phase(dut, ref, frequency, x_increment, window=np.hanning):
+    """BodePoint of waveforms of the same acquisition, given in volts.
+
+    dut is one waveform, or a 2D array with one waveform per row for several DUTs against
+    the same reference, whose BodePoint fields (except the frequency) hold one entry per row.
+    """
+    dut = np.asarray(dut)
+    phasors = tone_phasors(np.vstack([dut, ref]), frequency, x_increment, window)
+    dut_phasor, ref_phasor = phasors[:-1], phasors[-1]
+    transfer = dut_phasor / ref_phasor
+    if dut.ndim == 1:
+        return BodePoint(frequency, float(np.abs(transfer[0])), float(np.degrees(np.angle(transfer[0]))),
+                         float(np.abs(dut_phasor[0])), float(np.abs(ref_phasor)))
+    return BodePoint(frequency, np.abs(transfer), np.degrees(np.angle(transfer)),
+                     np.abs(dut_phasor), np.full(len(transfer), np.abs(ref_phasor)))
+
+
+def channel_map(dut_channel, ref_channel):
+    """Validated (DUT channels, reference channel) of one or up to three DUT channels"""
+    duts = (dut_channel,) if np.isscalar(dut_channel) else tuple(dut_channel)
+    channels = duts + (ref_channel,)
+    if not 1 <= len(duts) <= 3:
+        raise ValueError(f'One to three DUT channels are needed, got {len(duts)}')
+    if len(set(channels)) != len(channels) or not all(1 <= channel <= 4 for channel in channels):
+        raise ValueError(f'The DUT channels {duts} and the reference channel {ref_channel} '
+                         'must be different scope channels 1 to 4')
+    return duts, ref_channel
+
+
+def measure_bode_point(scope, frequency, dut_channel=1, ref_channel=2, window=np.hanning):
+    """Triggers one acquisition and returns the BodePoint at the excitation frequency.
+
+    The scope timebase should show a few periods at least (10 or more give the best
+    rejection), all channels are read as 1200 point screen waveforms. dut_channel is one
+    channel or a sequence of up to three, the BodePoint fields hold one entry per DUT then.
+    """
+    duts, ref_channel = channel_map(dut_channel, ref_channel)
+    scope.single_trigger()
+    scope.wait_for_acquisition()
+    waveforms, preambles = scope.get_screen_waveforms(duts + (ref_channel,))
+    points = min(len(waveforms[channel]) for channel in waveforms)
+    volts = np.empty((len(duts) + 1, points), dtype=np.float64)
+    for row, channel in enumerate(duts + (ref_channel,)):
+        scale_uint8(waveforms[channel][:points], preambles[channel], out=volts[row])
+    dut = volts[0] if np.isscalar(dut_channel) else volts[:-1]
+    return gain_phase(dut, volts[-1], frequency, preambles[ref_channel].x_increment, window)
+
+
+# checks the channel map and, with memory_depth, sets the memory depth if the scope allows
+# it with all channels of the map enabled
+def _prepare_channels(scope, dut_channel, ref_channel, memory_depth):
+    duts, ref_channel = channel_map(dut_channel, ref_channel)
+    if memory_depth is not None:
+        channels = set(scope.get_enabled_channels()) | set(duts + (ref_channel,))
+        scope.setup_mem_depth(memory_depth, channels=len(channels))
+
+
+def analyze_sweep(dut, ref, dut_preamble, ref_preamble, points=200, cycles=8, window=np.hanning, dtype=np.float32):
+    """Gain and phase versus frequency from one capture of a swept sine, as a BodePoint of arrays.
+
+    dut and ref are the uint8 captures of the DUT output and the excitation (reference) of
+    the same acquisition. The instantaneous phase of the sweep is recovered from the rising
+    mid level crossings of the reference, so any sweep law works and the sweep start does
+    not have to be known. Up to points blocks of cycles reference periods each, spaced
+    logarithmically over the swept range, are demodulated with the reference phase. Only
+    one block at a time is scaled (to dtype), the captures are never converted as a whole.
+    """
+    crossings = WaveformMeasurements(ref, ref_preamble, histogram=False).rising_edges[1]
+    if len(crossings) <= cycles:
+        raise ValueError(f'The reference has {len(crossings)} periods, at least {cycles + 1} are needed')
+    starts, stops = crossings[:-cycles], crossings[cycles:]
+    block_frequencies = cycles / ((stops - starts) * ref_preamble.x_increment)
+
+    # block whose frequency is nearest to each of the log spaced target frequencies
+    order = np.argsort(block_frequencies)
+    sorted_frequencies = np.log(block_frequencies[order])
+    targets = np.linspace(sorted_frequencies[0], sorted_frequencies[-1], points)
+    nearest = np.clip(np.searchsorted(sorted_frequencies, targets), 1, len(order) - 1)
+    nearest -= (targets - sorted_frequencies[nearest - 1]) < (sorted_frequencies[nearest] - targets)
+    blocks = order[np.unique(nearest)]
+    blocks.sort()
+
+    longest = int(np.max(stops[blocks] - starts[blocks])) + 2
+    dut_volts = np.empty(longest, dtype=dtype)
+    ref_volts = np.empty(longest, dtype=dtype)
+    phasors = np.empty((2, len(blocks)), dtype=np.complex128)
+    for i, block in enumerate(blocks):
+        first, last = int(np.ceil(starts[block])), int(np.floor(stops[block]))
+        samples = np.arange(first, last + 1)
+        phase = np.interp(samples, crossings[block:block + cycles + 1], 2 * np.pi * np.arange(cycles + 1))
+        weights = window(len(samples))
+        kernel = (weights * np.exp(-1j * phase)).astype(np.result_type(dtype, np.complex64))
+        for row, data, preamble, volts in ((0, dut, dut_preamble, dut_volts), (1, ref, ref_preamble, ref_volts)):
+            block_volts = scale_uint8(data[first:last + 1], preamble, out=volts)
+            phasors[row, i] = 2 * np.dot(block_volts - block_volts.mean(), kernel) / weights.sum()
+    transfer = phasors[0] / phasors[1]
+    return BodePoint(block_frequencies[blocks], np.abs(transfer), np.degrees(np.angle(transfer)),
+                     np.abs(phasors[0]), np.abs(phasors[1]))
+
+
+# 1-2-5 steps of the scope settings within a decade
+SETTING_STEPS = np.array([1.0, 2.0, 5.0, 10.0])
+
+
+def ceil_125(values):
+    """Smallest 1-2-5 step (1, 2, 5, 10, 20, ...) greater than or equal to each value"""
+    values = np.asarray(values, dtype=np.float64)
+    decade = 10**np.floor(np.log10(values))
+    # the tolerance keeps exact steps (e.g. 1 ms for 1 kHz) from rounding up to the next one
+    return SETTING_STEPS[np.searchsorted(SETTING_STEPS, values / decade * (1 - 1e-9))] * decade
+
+
+def time_per_div_for(frequency, periods_per_div=1.0):
+    """Smallest 1-2-5 timebase (s/div) showing periods_per_div periods per division or more"""
+    return ceil_125(periods_per_div / np.asarray(frequency, dtype=np.float64))
+
+
+def _refinement_errors(frequencies, gain_db, phase):
+    """Deviation of every inner point from the log frequency interpolation of its neighbours"""
+    x = np.log(frequencies)
+    position = (x[1:-1] - x[:-2]) / (x[2:] - x[:-2])
+    # one column per DUT for a multi DUT sweep
+    position = position.reshape(position.shape + (1,) * (gain_db.ndim - 1))
+    gain_error = np.abs(gain_db[1:-1] - (gain_db[:-2] + position * (gain_db[2:] - gain_db[:-2])))
+    phase_error = np.abs(phase[1:-1] - (phase[:-2] + position * (phase[2:] - phase[:-2])))
+    return gain_error, phase_error
+
+
+def adaptive_sweep(measure, start, stop, initial_points=9, max_points=50, gain_tolerance=0.5,
+                   phase_tolerance=5.0, min_ratio=1.01):
+    """Bode curve measured on a coarse log grid, refined only where the curve is not straight.
+
+    measure is called with a frequency and returns its BodePoint (e.g. a closure around
+    measure_bode_point). Every point deviating by more than gain_tolerance (dB) or
+    phase_tolerance (degrees) from the log frequency interpolation of its neighbours, i.e.
+    every point of a curved region, gets new points at the log midpoints of both adjacent
+    intervals. With several DUTs per point the worst one decides. Refining is repeated
+    until all points are within tolerance, max_points are measured, or the intervals left
+    to split are narrower than the frequency ratio min_ratio. Returns a BodePoint of
+    arrays sorted by frequency.
+    """
+    if initial_points < 3 or max_points < initial_points:
+        raise ValueError('At least three initial points and max_points >= initial_points are needed')
+    points = [measure(frequency) for frequency in np.geomspace(start, stop, initial_points)]
+    while len(points) < max_points:
+        frequencies = np.array([point.frequency for point in points])
+        gain_db = np.array([point.gain_db for point in points])
+        phase = np.unwrap(np.array([point.phase for point in points]), period=360, axis=0)
+        gain_error, phase_error = _refinement_errors(frequencies, gain_db, phase)
+        # the worst DUT of a multi DUT sweep decides
+        score = np.maximum(gain_error / gain_tolerance, phase_error / phase_tolerance)
+        score = score.reshape(len(score), -1).max(axis=1)
+        # an interval is scored by the worse of the two inner points it borders
+        interval_score = np.zeros(len(points) - 1)
+        interval_score[:-1] = score
+        interval_score[1:] = np.maximum(interval_score[1:], score)
+        interval_score[frequencies[1:] / frequencies[:-1] < min_ratio**2] = 0
+        split = np.flatnonzero(interval_score > 1)
+        if not len(split):
+            break
+        # worst intervals first when the budget does not cover all of them, measured in
+        # ascending frequency to keep the instrument settings changes small
+        split = np.sort(split[np.argsort(-interval_score[split], kind='stable')][:max_points - len(points)])
+        new = [measure(np.sqrt(frequencies[i] * frequencies[i + 1])) for i in split]
+        points = sorted(points + new, key=lambda point: point.frequency)
+    return BodePoint(*(np.array(values) for values in zip(*points)))
+
+
+def stepped_bode_sweep(scope, fgen, start, stop, source=1, dut_channel=1, ref_channel=2, periods_per_div=1.0,
+                       memory_depth=None, **refinement):
+    """Adaptive stepped sweep, the fgen source drives the DUT(s) and the reference channel.
+
+    For every frequency the source is retuned and the scope timebase set to the 1-2-5 step
+    showing periods_per_div periods per division or more. dut_channel is one channel or up
+    to three, memory_depth is checked against the channels of the sweep and set before it.
+    The refinement keywords are passed to adaptive_sweep.
+    """
+    _prepare_channels(scope, dut_channel, ref_channel, memory_depth)
+
+    def measure(frequency):
+        fgen.setFrequency(source, frequency=frequency)
+        time_per_div = float(time_per_div_for(frequency, periods_per_div))
+        scope.setup_timebase(time_per_div=time_per_div, delay=time_per_div * 5)
+        return measure_bode_point(scope, frequency, dut_channel, ref_channel)
+    return adaptive_sweep(measure, start, stop, **refinement)
+
+
+class SweepPlan:
+    """Per point settings of a stepped sweep, computed up front for all frequencies at once.
+
+    A plan holds one entry per frequency of the source frequency, the timebase and its
+    delay, the volts/div of the measured channels and the time to wait for the DUT to settle
+    after retuning. run() only sends the settings that change from one point to the next.
+    Plans are created with create() and can be saved and loaded again (.npz files).
+    """
+
+    # DS1000Z setting ranges (volts/div for a 1x probe)
+    class limits:
+        MIN_TIME_PER_DIV = 5e-9
+        MAX_TIME_PER_DIV = 50.0
+        MIN_VOLTS_PER_DIV = 1e-3
+        MAX_VOLTS_PER_DIV = 10.0
+
+    def __init__(self, frequency, time_per_div, delay, volts_per_div, settle):
+        self.frequency = np.asarray(frequency, dtype=np.float64)
+        self.time_per_div = np.asarray(time_per_div, dtype=np.float64)
+        self.delay = np.asarray(delay, dtype=np.float64)
+        self.volts_per_div = np.asarray(volts_per_div, dtype=np.float64)
+        self.settle = np.asarray(settle, dtype=np.float64)
+
+    @classmethod
+    def create(cls, frequencies, amplitude=1.0, periods_per_div=1.0, delay_divs=5.0, amplitude_divs=6.0,
+               settle_periods=10.0, settle_time=0.0, limits=limits):
+        """Plan of the frequencies for an expected peak to peak amplitude (volts, per point or one for all).
+
+        The timebase is the smallest 1-2-5 step showing periods_per_div periods per division,
+        the vertical scale the smallest 1-2-5 step keeping amplitude within amplitude_divs
+        divisions, both clipped to the limits. The trigger point is delay_divs divisions left
+        of the screen center. Before each acquisition the plan waits
+        settle_periods periods of the new frequency, but settle_time seconds at least.
+        """
+        frequency = np.asarray(frequencies, dtype=np.float64)
+        time_per_div = np.clip(time_per_div_for(frequency, periods_per_div),
+                               limits.MIN_TIME_PER_DIV, limits.MAX_TIME_PER_DIV)
+        volts_per_div = np.clip(ceil_125(np.broadcast_to(amplitude, frequency.shape) / amplitude_divs),
+                                limits.MIN_VOLTS_PER_DIV, limits.MAX_VOLTS_PER_DIV)
+        settle = np.maximum(settle_periods / frequency, settle_time)
+        return cls(frequency, time_per_div, time_per_div * delay_divs, volts_per_div, settle)
+
+    def __len__(self):
+        return len(self.frequency)
+
+    # True for every point where the setting differs from the previous point
+    @staticmethod
+    def _changes(values):
+        return np.concatenate([[True], values[1:] != values[:-1]])
+
+    def save(self, filename):
+        np.savez(filename, frequency=self.frequency, time_per_div=self.time_per_div, delay=self.delay,
+                 volts_per_div=self.volts_per_div, settle=self.settle)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as arrays:
+            return cls(**{name: arrays[name] for name in arrays.files})
+
+    def run(self, scope, fgen, source=1, dut_channel=1, ref_channel=2, window=np.hanning, memory_depth=None):
+        """Measures every point of the plan and returns the curve as a BodePoint of arrays.
+
+        dut_channel is one channel or up to three, their gain and phase arrays have one
+        column per DUT then. memory_depth is checked against the channels and set first.
+        """
+        _prepare_channels(scope, dut_channel, ref_channel, memory_depth)
+        duts, ref_channel = channel_map(dut_channel, ref_channel)
+        timebase_changes = self._changes(self.time_per_div) | self._changes(self.delay)
+        scale_changes = self._changes(self.volts_per_div)
+        points = []
+        for i in range(len(self)):
+            fgen.setFrequency(source, frequency=float(self.frequency[i]))
+            if timebase_changes[i]:
+                scope.setup_timebase(time_per_div=float(self.time_per_div[i]), delay=float(self.delay[i]))
+            if scale_changes[i]:
+                for channel in duts + (ref_channel,):
+                    scope.setup_scale(channel, float(self.volts_per_div[i]))
+            time.sleep(float(self.settle[i]))
+            points.append(measure_bode_point(scope, float(self.frequency[i]), dut_channel, ref_channel, window))
+        return BodePoint(*(np.array(values) for values in zip(*points)))
@@ -0,0 +1,324 @@
+import numpy as np
+from Rigol.waveform import scale_lut
+
+# Client side counterpart of the :MEAS:ITEM? measurements, computed from a downloaded uint8
+# capture and its WaveformPreamble. Amplitude items come from one histogram of the 256
+# possible codes, time items from a hysteresis edge detection on the raw codes, both
+# vectorized over the whole capture (not only the 1200 screen points the scope uses).
+# Results follow the scope: ratios (OVER, PRES, PDUT, NDUT) are returned as fractions,
+# items that cannot be determined (e.g. no edges) are nan. Period, widths, rise and fall
+# times are averaged over all edges of the capture instead of taken from the first one.
+
+# upper, middle and lower threshold in percent of top - base, the scope defaults
+DEFAULT_THRESHOLDS = (90.0, 50.0, 10.0)
+
+
+def _interpolate(data, k, level):
+    """Fractional index where data crosses level between the samples k and k + 1"""
+    left = data[k].astype(np.float64)
+    right = data[k + 1].astype(np.float64)
+    return k + (level - left) / (right - left)
+
+
+def _crossings(data, level, rising):
+    """Indices k with data[k] < level <= data[k + 1] (rising) or data[k] >= level > data[k + 1]"""
+    low = data < level
+    if rising:
+        return np.flatnonzero(low[:-1] & ~low[1:])
+    return np.flatnonzero(~low[:-1] & low[1:])
+
+
+class WaveformMeasurements:
+    """Measurements of one uint8 capture, every quantity is computed once on first use.
+
+    With histogram=False top and base are the maximum and minimum instead of the histogram
+    modes, for captures dominated by a flat stretch (e.g. before a sweep starts).
+    """
+
+    def __init__(self, data, preamble, thresholds=DEFAULT_THRESHOLDS, histogram=True):
+        self.data = np.asarray(data)
+        if self.data.dtype != np.uint8:
+            raise TypeError(f'Expected uint8 waveform points, got {self.data.dtype}')
+        if len(self.data) < 2:
+            raise ValueError('At least two points are needed')
+        self.preamble = preamble
+        self.thresholds = thresholds
+        self.use_histogram = histogram
+        self.volts = scale_lut(preamble, np.float64)
+        self._cache = {}
+
+    def _cached(self, key, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    # code (raw point value) to volts, codes may be fractional
+    def _to_volts(self, code):
+        return (code - self.preamble.y_origin - self.preamble.y_reference) * self.preamble.y_increment
+
+    # zero based, possibly fractional point index to seconds relative to the trigger
+    def _to_time(self, index):
+        return self.preamble.x_origin + (index - self.preamble.x_reference) * self.preamble.x_increment
+
+    # AMPLITUDE
+
+    @property
+    def histogram(self):
+        return self._cached('histogram', lambda: np.bincount(self.data, minlength=256))
+
+    def _code_range(self):
+        occupied = np.flatnonzero(self.histogram)
+        return int(occupied[0]), int(occupied[-1])
+
+    # most frequent code in the upper and lower half of the range, like the histogram mode
+    # of the scope, which falls back to max and min for waveforms without flat parts
+    def _top_base_codes(self):
+        def compute():
+            low, high = self._code_range()
+            if low == high or not self.use_histogram:
+                return high, low
+            middle = (low + high) / 2
+            upper = int(np.ceil(middle))
+            lower = int(np.floor(middle))
+            top = upper + int(np.argmax(self.histogram[upper:high + 1]))
+            base = low + int(np.argmax(self.histogram[low:lower + 1]))
+            return top, base
+        return self._cached('top_base', compute)
+
+    def _threshold_codes(self):
+        top, base = self._top_base_codes()
+        return tuple(base + (top - base) * percent / 100 for percent in self.thresholds)
+
+    def _moment(self, power):
+        return float(np.dot(self.histogram, self.volts**power) / len(self.data))
+
+    # EDGES
+
+    # (lower crossing, mid crossing, upper crossing) fractional indices per rising or falling
+    # edge. An edge needs to pass from beyond one outer threshold to beyond the other one,
+    # so noise around a single threshold does not count (hysteresis). Only the sparse
+    # threshold crossings are indexed, no full size index arrays are created
+    def _edges(self, rising):
+        def compute():
+            upper, mid, lower = self._threshold_codes()
+            if upper <= lower:
+                return np.empty((3, 0))
+            # codes are integers, data <= lower is data < below_lower
+            below_lower = np.floor(lower) + 1
+            # first point at or above upper, first point at or below lower
+            high_entries = _crossings(self.data, upper, True) + 1
+            low_entries = _crossings(self.data, below_lower, False) + 1
+            events = np.concatenate([high_entries, low_entries])
+            kinds = np.concatenate([np.ones(len(high_entries), bool), np.zeros(len(low_entries), bool)])
+            if self.data[0] >= upper or self.data[0] < below_lower:
+                events = np.append(events, 0)
+                kinds = np.append(kinds, self.data[0] >= upper)
+            order = np.argsort(events, kind='stable')
+            events, kinds = events[order], kinds[order]
+            # the first entry of every run of entries into the same side changes the state
+            first = np.concatenate([[True], kinds[1:] != kinds[:-1]])
+            events, kinds = events[first], kinds[first]
+            end = events[1:][kinds[1:] == rising]
+            # last point beyond the threshold the edge starts from
+            exits = _crossings(self.data, below_lower, True) if rising else _crossings(self.data, upper, False)
+            start = exits[np.searchsorted(exits, end) - 1]
+            mids = _crossings(self.data, mid, rising)
+            mid_index = mids[np.searchsorted(mids, end) - 1]
+            if rising:
+                return np.array([_interpolate(self.data, start, lower),
+                                 _interpolate(self.data, mid_index, mid),
+                                 _interpolate(self.data, end - 1, upper)])
+            return np.array([_interpolate(self.data, end - 1, lower),
+                             _interpolate(self.data, mid_index, mid),
+                             _interpolate(self.data, start, upper)])
+        return self._cached(('edges', rising), compute)
+
+    @property
+    def rising_edges(self):
+        return self._edges(True)
+
+    @property
+    def falling_edges(self):
+        return self._edges(False)
+
+    def _period_points(self):
+        mids = self.rising_edges[1]
+        if len(mids) < 2:
+            return np.nan
+        return float(np.mean(np.diff(mids)))
+
+    # mean distance from every mid crossing in starts to the next one in ends
+    def _width_points(self, starts, ends):
+        following = np.searchsorted(ends, starts)
+        valid = following < len(ends)
+        if not valid.any():
+            return np.nan
+        return float(np.mean(ends[following[valid]] - starts[valid]))
+
+    def _area(self, start, stop):
+        segment = self.volts[self.data[start:stop]]
+        return float(np.sum(segment) * self.preamble.x_increment)
+
+    # ITEMS, keyed by the :MEAS:ITEM command
+
+    def VMAX(self):
+        return float(self.volts[self._code_range()[1]])
+
+    def VMIN(self):
+        return float(self.volts[self._code_range()[0]])
+
+    def VPP(self):
+        return self.VMAX() - self.VMIN()
+
+    def VTOP(self):
+        return float(self.volts[self._top_base_codes()[0]])
+
+    def VBAS(self):
+        return float(self.volts[self._top_base_codes()[1]])
+
+    def VAMP(self):
+        return self.VTOP() - self.VBAS()
+
+    def VAVG(self):
+        return self._moment(1)
+
+    def VRMS(self):
+        return float(np.sqrt(self._moment(2)))
+
+    def VARI(self):
+        return self._moment(2) - self._moment(1)**2
+
+    def VUP(self):
+        return float(self._to_volts(self._threshold_codes()[0]))
+
+    def VMID(self):
+        return float(self._to_volts(self._threshold_codes()[1]))
+
+    def VLOW(self):
+        return float(self._to_volts(self._threshold_codes()[2]))
+
+    def OVER(self):
+        return (self.VMAX() - self.VTOP()) / self.VAMP() if self.VAMP() else np.nan
+
+    def PRES(self):
+        return (self.VBAS() - self.VMIN()) / self.VAMP() if self.VAMP() else np.nan
+
+    def PER(self):
+        return self._period_points() * self.preamble.x_increment
+
+    def FREQ(self):
+        return 1 / self.PER()
+
+    # rms over the whole periods between the first and the last rising mid crossing
+    def PVRMS(self):
+        mids = self.rising_edges[1]
+        if len(mids) < 2:
+            return np.nan
+        segment = self.volts[self.data[int(np.ceil(mids[0])):int(np.ceil(mids[-1]))]]
+        return float(np.sqrt(np.mean(segment**2)))
+
+    def RTIM(self):
+        lower, _, upper = self.rising_edges
+        return float(np.mean(upper - lower) * self.preamble.x_increment) if len(lower) else np.nan
+
+    def FTIM(self):
+        lower, _, upper = self.falling_edges
+        return float(np.mean(lower - upper) * self.preamble.x_increment) if len(lower) else np.nan
+
+    def PWID(self):
+        return self._width_points(self.rising_edges[1], self.falling_edges[1]) * self.preamble.x_increment
+
+    def NWID(self):
+        return self._width_points(self.falling_edges[1], self.rising_edges[1]) * self.preamble.x_increment
+
+    def PDUT(self):
+        return self.PWID() / self.PER()
+
+    def NDUT(self):
+        return self.NWID() / self.PER()
+
+    def TVMAX(self):
+        return float(self._to_time(np.argmax(self.data)))
+
+    def TVMIN(self):
+        return float(self._to_time(np.argmin(self.data)))
+
+    # a positive pulse is a rising edge followed by a falling edge
+    def PPUL(self):
+        rising, falling = self.rising_edges[1], self.falling_edges[1]
+        return int(np.count_nonzero(np.searchsorted(falling, rising) < len(falling)))
+
+    def NPUL(self):
+        rising, falling = self.rising_edges[1], self.falling_edges[1]
+        return int(np.count_nonzero(np.searchsorted(rising, falling) < len(rising)))
+
+    def PEDG(self):
+        return self.rising_edges.shape[1]
+
+    def NEDG(self):
+        return self.falling_edges.shape[1]
+
+    def PSLEW(self):
+        return (self.VUP() - self.VLOW()) / self.RTIM()
+
+    def NSLEW(self):
+        return (self.VLOW() - self.VUP()) / self.FTIM()
+
+    def MAR(self):
+        return float(np.dot(self.histogram, self.volts) * self.preamble.x_increment)
+
+    def MPAR(self):
+        mids = self.rising_edges[1]
+        if len(mids) < 2:
+            return np.nan
+        return self._area(int(np.ceil(mids[0])), int(np.ceil(mids[1])))
+
+    # items comparing this capture (source 1) with another one (source 2) of the same acquisition
+
+    def _delay(self, other, rising):
+        own = (self.rising_edges if rising else self.falling_edges)[1]
+        theirs = (other.rising_edges if rising else other.falling_edges)[1]
+        if not len(own) or not len(theirs):
+            return np.nan
+        # edge of source 2 nearest to the first edge of source 1
+        nearest = theirs[np.argmin(np.abs(other._to_time(theirs) - self._to_time(own[0])))]
+        return float(other._to_time(nearest) - self._to_time(own[0]))
+
+    def RDEL(self, other):
+        return self._delay(other, True)
+
+    def FDEL(self, other):
+        return self._delay(other, False)
+
+    def RPH(self, other):
+        return self.RDEL(other) / self.PER() * 360
+
+    def FPH(self, other):
+        return self.FDEL(other) / self.PER() * 360
+
+    # dict of item name to value, other is the WaveformMeasurements of source 2 for the
+    # items comparing two sources
+    def measure(self, items, other=None):
+        results = {}
+        for item in items:
+            method = getattr(self, item.command, None)
+            if method is None:
+                raise ValueError(f'No client side implementation of {item.command}')
+            if item.command in ('RDEL', 'FDEL', 'RPH', 'FPH'):
+                if other is None:
+                    raise ValueError(f'{item.command} needs a second source')
+                value = method(other)
+            else:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    value = method()
+            results[item.name] = value
+        return results
+
+
+def measure_waveform(data, preamble, items, compare=None, compare_preamble=None, thresholds=DEFAULT_THRESHOLDS):
+    """Computes the measurement items of a uint8 capture, compare is the capture of source 2"""
+    measurements = WaveformMeasurements(data, preamble, thresholds)
+    other = None
+    if compare is not None:
+        other = WaveformMeasurements(compare, compare_preamble or preamble, thresholds)
+    return measurements.measure(items, other)
@@ -0,0 +1,169 @@
+import atexit
+import threading
+import time
+import logging
+import pyvisa as visa
+from Rigol.socket_session import RawSocketSession, parse_socket_resource
+
+# Module wide pool of VISA sessions.
+#
+# All drivers share one ResourceManager. Sessions are kept open per resource string and
+# handed to every driver opening the same resource, even after the previous driver was
+# closed, so reopening an instrument costs a *IDN? health check instead of a new session.
+# Sessions are opened with exponential backoff, broken ones are replaced by reconnect().
+#
+# The transport behind a session is pluggable: backends registered with register_backend()
+# are asked in order whether they handle a resource string before falling back to VISA.
+# By default raw ::SOCKET resources use the native RawSocketSession.
+
+logger = logging.getLogger(__name__)
+
+# errors of a lost or unusable session, pyvisa-py reports socket failures as OSError
+CONNECTION_ERRORS = (visa.errors.Error, OSError)
+
+
+def is_timeout(error):
+    return isinstance(error, visa.errors.VisaIOError) and error.error_code == visa.constants.StatusCode.error_timeout
+
+
+class Connection:
+    """One VISA session, its lock and the number of drivers using it.
+
+    device is None until the pool opened the session, the lock is held while it does so.
+    """
+
+    def __init__(self, resource, device):
+        self.resource = resource
+        self.device = device
+        # shared by every driver using the session, see _RigolInstrument.transaction()
+        self.lock = threading.RLock()
+        self.users = 0
+
+
+class ConnectionPool:
+
+    # seconds to wait before the first reopen attempt, doubled per attempt
+    reconnect_delay = 0.05
+    reconnect_attempts = 6
+    # I/O timeout of the *IDN? health check in seconds
+    check_timeout = 1.0
+
+    def __init__(self, backend='@py'):
+        self.backend = backend
+        self._manager = None
+        self._connections = {}
+        self._lock = threading.Lock()
+        # (matches(resource), open(resource)) pairs tried before VISA
+        self.backends = [(lambda resource: parse_socket_resource(resource) is not None,
+                          RawSocketSession.from_resource)]
+
+    @property
+    def manager(self):
+        with self._lock:
+            if self._manager is None:
+                self._manager = visa.ResourceManager(self.backend)
+            return self._manager
+
+    # open(resource) has to return an object with the interface of a pyvisa resource used by
+    # the drivers: write, query, read_raw, read_bytes, timeout (ms), close and optionally read_into
+    def register_backend(self, matches, open):
+        self.backends.insert(0, (matches, open))
+
+    def _open_session(self, resource):
+        for matches, open in self.backends:
+            if matches(resource):
+                return open(resource)
+        return self.manager.open_resource(resource)
+
+    # opens a session, retrying with exponential backoff while the instrument is unreachable
+    def _open(self, resource):
+        delay = self.reconnect_delay
+        for attempt in range(1, self.reconnect_attempts + 1):
+            try:
+                return self._open_session(resource)
+            except CONNECTION_ERRORS as error:
+                if attempt == self.reconnect_attempts:
+                    raise
+                logger.warning(f'Opening {resource} failed ({error}), retrying in {delay:.2f} s')
+                time.sleep(delay)
+                delay *= 2
+
+    # True if the session answers *IDN? within check_timeout
+    def is_healthy(self, connection):
+        device = connection.device
+        previous = device.timeout
+        try:
+            device.timeout = int(self.check_timeout * 1000)
+            return bool(device.query('*IDN?').strip())
+        except CONNECTION_ERRORS:
+            return False
+        finally:
+            try:
+                device.timeout = previous
+            except CONNECTION_ERRORS:
+                pass
+
+    # the pooled connection of resource, opened if needed. A session reused from the pool
+    # is health checked first and reopened if it does not answer. The pool lock only guards
+    # the lookup, opening and checking hold the lock of the connection, so a slow or
+    # unreachable instrument only delays the drivers of the same resource
+    def acquire(self, resource):
+        with self._lock:
+            connection = self._connections.get(resource)
+            if connection is None:
+                connection = Connection(resource, None)
+                self._connections[resource] = connection
+            connection.users += 1
+        try:
+            with connection.lock:
+                if connection.device is None:
+                    connection.device = self._open(resource)
+                elif not self.is_healthy(connection):
+                    logger.warning(f'Pooled session to {resource} does not answer, reopening')
+                    self._reopen(connection)
+        except BaseException:
+            with self._lock:
+                connection.users -= 1
+                # a session that could not be opened is not pooled
+                if connection.device is None and not connection.users \
+                        and self._connections.get(resource) is connection:
+                    del self._connections[resource]
+            raise
+        return connection
+
+    # the session stays open for the next acquire() of the same resource
+    def release(self, connection):
+        with self._lock:
+            connection.users = max(connection.users - 1, 0)
+
+    def _reopen(self, connection):
+        try:
+            connection.device.close()
+        except CONNECTION_ERRORS:
+            pass
+        connection.device = self._open(connection.resource)
+        return connection
+
+    # replaces the session of connection by a new one, for every driver using it
+    def reconnect(self, connection):
+        with connection.lock:
+            return self._reopen(connection)
+
+    # closes every pooled session, drivers still using one have to acquire it again
+    def close_all(self):
+        with self._lock:
+            for connection in self._connections.values():
+                if connection.device is None:
+                    continue
+                try:
+                    connection.device.close()
+                except CONNECTION_ERRORS:
+                    pass
+            self._connections.clear()
+            if self._manager is not None:
+                self._manager.close()
+                self._manager = None
+
+
+pool = ConnectionPool()
+atexit.register(pool.close_all)
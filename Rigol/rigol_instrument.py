@@ -0,0 +1,405 @@
+import time
+import logging
+import functools
+from contextlib import contextmanager
+import pyvisa as visa
+from Rigol.rigol_util import CustomLogger
+from Rigol.pool import pool, Connection, CONNECTION_ERRORS, is_timeout
+
+
+# sends all commands of a setter as one batch, i.e. one program message
+def batched(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.batch():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# holds the session lock for the whole method, so its commands and the replies it reads
+# are not interleaved with those of other threads using the same instrument
+def exclusive(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.transaction():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class _RigolInstrument:
+    """SCPI session shared by the scope and fgen drivers"""
+
+    # longest program message a batch flushes at once, stays well within the input buffer
+    max_message_length = 1024
+    # seconds a synchronization call waits for the instrument before raising TimeoutError
+    sync_timeout = 10.0
+    # seconds the instrument may need to come back after *RST
+    reset_timeout = 15.0
+
+    # Constructor
+    # the session is taken from the module wide pool (see Rigol.pool), an already open
+    # session (anything with write/read_raw/read_bytes/query) can be passed as device instead
+    def __init__(self, resource, loglevel=logging.INFO, shadow=False, device=None):
+        self.logger = CustomLogger(self.__class__.__name__, loglevel)
+        self.resource = resource
+
+        if device is not None:
+            self._connection = Connection(resource, device)
+            self._pooled = False
+        else:
+            try:
+                self._connection = pool.acquire(resource)
+            except CONNECTION_ERRORS as error:
+                self.logger.critical(f'Could not open {resource}: {error}')
+                raise
+            self._pooled = True
+        # commands collected by batch(), None outside of a batch
+        self._batch = None
+        # shadow cache when the batch started, to drop what it recorded if it fails
+        self._batch_snapshot = None
+        # last value written per SCPI header, None while the shadow cache is disabled
+        self._shadow = {} if shadow else None
+        # headers whose shadow value was read back from the instrument
+        self._shadow_confirmed = set()
+
+    @property
+    def device(self):
+        return self._connection.device
+
+    # serializes the I/O of threads sharing this session, see transaction()
+    @property
+    def _lock(self):
+        return self._connection.lock
+
+    # opens a new session to the instrument (with backoff), replacing the broken one
+    def reconnect(self):
+        if not self._pooled:
+            raise ConnectionError(f'Session to {self.resource} was not opened by the pool')
+        self.logger.warning(f'Reconnecting to {self.resource}')
+        pool.reconnect(self._connection)
+
+    # hands the session back to the pool, which keeps it open for the next driver
+    def close(self):
+        if self._pooled:
+            pool.release(self._connection)
+        else:
+            self.device.close()
+
+    # a single message is resent once over a new session if the old one is lost
+    def _retry_on_connection_error(self, operation):
+        try:
+            return operation()
+        except CONNECTION_ERRORS as error:
+            if not self._pooled or is_timeout(error):
+                raise
+            self.logger.error(f'Lost session to {self.resource}: {error}')
+            self.reconnect()
+            return operation()
+
+    # gets the session usable again after a failed transfer: after a timeout or a malformed
+    # reply the rest of the pending reply is discarded with a device clear, a lost session
+    # is reopened
+    def recover_session(self, error):
+        lost = isinstance(error, CONNECTION_ERRORS) and not is_timeout(error)
+        if not lost and hasattr(self.device, 'clear'):
+            try:
+                self.device.clear()
+                return
+            except CONNECTION_ERRORS:
+                pass
+        elif not isinstance(error, CONNECTION_ERRORS):
+            return
+        self.reconnect()
+
+    def _write(self, command):
+        self.logger.debug(f'Sent command: {command}')
+        self._retry_on_connection_error(lambda: self.device.write(command))
+
+    # inside a batch commands are collected, a query flushes them together with itself
+    def send_command(self, command):
+        with self._lock:
+            self._send_command(command)
+
+    def _send_command(self, command):
+        with self._shadow_rollback():
+            if self._shadow is not None and not self._shadow_write(command):
+                self.logger.debug(f'Skipped unchanged setting: {command}')
+                return
+            if self._batch is not None:
+                if '?' not in command:
+                    self._batch.append(command)
+                    return
+                *messages, command = self._pop_batch_messages(command)
+                for message in messages:
+                    self._write(message)
+            self._write(command)
+
+    def read_response(self):
+        with self._lock:
+            buffer = self.device.read_raw()
+        self.logger.debug(f'Got response: {buffer}')
+        return buffer
+
+    def query_command(self, command):
+        with self._lock:
+            if self._batch:
+                *messages, command = self._pop_batch_messages(command)
+                with self._shadow_rollback():
+                    for message in messages:
+                        self._write(message)
+            buffer = self._retry_on_connection_error(lambda: self.device.query(command))
+        filtered_buffer = buffer.replace("\n", "\\n")
+        self.logger.debug(f'Query sent: {command}, got: {filtered_buffer}')
+        return buffer
+
+    # sends the queries packed into as few program messages as possible and returns one reply
+    # string per query. Replies to a message arrive ';' separated in one response, replies
+    # sent as separate responses are read until every query is answered
+    @exclusive
+    def query_commands(self, queries):
+        queries = list(queries)
+        replies = []
+        for message in self._pack_messages(queries):
+            expected = len(replies) + message.count('?')
+            replies += self.query_command(message).strip().split(';')
+            while len(replies) < expected:
+                replies += self.read_response().decode().strip().split(';')
+        if len(replies) != len(queries):
+            raise ValueError(f'Expected {len(queries)} replies, got {len(replies)}')
+        return replies
+
+    # THREADING
+
+    # Every single command and query is atomic. A sequence of commands and the reads of its
+    # replies is only safe from other threads inside a transaction (or a batch, or a method
+    # decorated with exclusive), which holds the per instrument lock until the block ends.
+    # Transactions nest within one thread
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            yield
+
+    class loglevel:
+        INFO = logging.INFO
+        WARNING = logging.WARNING
+        ERROR = logging.ERROR
+        CRITICAL = logging.CRITICAL
+        DEBUG = logging.DEBUG
+
+    # BATCHING
+
+    # joins the pending commands (and final) into ';' separated program messages of at most
+    # max_message_length characters, final always ends the last message
+    def _pop_batch_messages(self, final=None):
+        commands = self._batch + ([final] if final else [])
+        self._batch.clear()
+        return self._pack_messages(commands)
+
+    def _pack_messages(self, commands):
+        messages = []
+        current = ''
+        for command in commands:
+            if current and len(current) + 1 + len(command) > self.max_message_length:
+                messages.append(current)
+                current = command
+            else:
+                current = f'{current};{command}' if current else command
+        if current:
+            messages.append(current)
+        return messages
+
+    def flush_batch(self):
+        with self._lock:
+            if self._batch:
+                with self._shadow_rollback():
+                    for message in self._pop_batch_messages():
+                        self._write(message)
+
+    # collects every command sent inside the with block and sends them as few program
+    # messages as possible when the block ends, with opc=True together with a trailing *OPC?
+    # that waits until the instrument executed them. Queries inside the block flush the
+    # commands collected so far. Nested batches join the outermost one. A batch is a
+    # transaction, other threads cannot add commands to it
+    @contextmanager
+    def batch(self, opc=False):
+        with self.transaction():
+            if self._batch is not None:
+                yield
+                return
+            self._batch = []
+            self._batch_snapshot = dict(self._shadow) if self._shadow is not None else None
+            try:
+                yield
+            except BaseException:
+                self.logger.warning(f'Dropped {len(self._batch)} batched commands')
+                self._discard_shadow_changes(self._batch_snapshot)
+                self._batch = self._batch_snapshot = None
+                raise
+            try:
+                if opc:
+                    self.wait_operation_complete()
+                else:
+                    self.flush_batch()
+            finally:
+                self._batch = self._batch_snapshot = None
+
+    # SHADOW STATE
+
+    # With the shadow cache enabled (shadow=True or enable_shadow()) the last value written
+    # per SCPI header is recorded, writes that would not change a setting are suppressed and
+    # query_setting() answers settings read back before without a round trip. The cache only
+    # knows what this session wrote or read, invalidate it when the instrument is operated by
+    # other means. Values are recorded as written, the instrument may have coerced them (e.g.
+    # 0.1667 V/div to 0.2), which is why query_setting() only answers read back values
+    def enable_shadow(self, enabled=True):
+        self._shadow = {} if enabled else None
+        self._shadow_confirmed.clear()
+
+    # forgets every setting starting with prefix, all of them without a prefix
+    def invalidate_shadow(self, prefix=None):
+        if self._shadow is None:
+            return
+        if prefix is None:
+            self._shadow.clear()
+            self._shadow_confirmed.clear()
+        else:
+            prefix = prefix.upper()
+            for header in [header for header in self._shadow if header.startswith(prefix)]:
+                del self._shadow[header]
+                self._shadow_confirmed.discard(header)
+
+    # the settings recorded since snapshot (a copy of the cache) are forgotten when their
+    # writes fail or their batch is dropped, the instrument may or may not have applied them
+    def _discard_shadow_changes(self, snapshot):
+        if self._shadow is None or snapshot is None:
+            return
+        for header in [header for header, value in self._shadow.items() if snapshot.get(header) != value]:
+            del self._shadow[header]
+            self._shadow_confirmed.discard(header)
+
+    # records optimistically inside the block and rolls back if it raises, inside a batch
+    # back to the state the batch started with
+    @contextmanager
+    def _shadow_rollback(self):
+        if self._batch is not None:
+            snapshot = self._batch_snapshot
+        else:
+            snapshot = dict(self._shadow) if self._shadow is not None else None
+        try:
+            yield
+        except BaseException:
+            self._discard_shadow_changes(snapshot)
+            raise
+
+    # headers (as prefixes) whose value changes implicitly when header is written
+    def _shadow_dependents(self, header):
+        return []
+
+    # records the write and returns whether it has to be sent
+    def _shadow_write(self, command):
+        header, _, value = command.strip().partition(' ')
+        header = header.upper()
+        if header.startswith('*'):
+            if header in ('*RST', '*RCL'):
+                self.invalidate_shadow()
+            return True
+        if '?' in header:
+            return True
+        if value and self._shadow.get(header) == value:
+            return False
+        for dependent in self._shadow_dependents(header):
+            self.invalidate_shadow(dependent)
+        # commands without parameter are actions (e.g. :RUN), they always go out
+        if value:
+            self._shadow[header] = value
+            self._shadow_confirmed.discard(header)
+        return True
+
+    # value of header read back from the instrument before, None if unknown
+    def _confirmed_setting(self, header):
+        header = header.upper()
+        if self._shadow is None or header not in self._shadow_confirmed:
+            return None
+        return self._shadow[header]
+
+    # value of a setting as applied by the instrument, from the shadow cache if it was read
+    # back before or else queried with header?
+    def query_setting(self, header, convert=str):
+        key = header.upper()
+        value = self._confirmed_setting(key)
+        if value is None:
+            value = self.query_command(f'{header}?').strip()
+            if self._shadow is not None:
+                self._shadow[key] = value
+                self._shadow_confirmed.add(key)
+        return convert(value)
+
+    # SYNCHRONIZATION
+
+    # bits of the standard event status register (*ESR?)
+    class event_status:
+        OPERATION_COMPLETE = 0x01
+        QUERY_ERROR = 0x04
+        DEVICE_ERROR = 0x08
+        EXECUTION_ERROR = 0x10
+        COMMAND_ERROR = 0x20
+        POWER_ON = 0x80
+
+    # temporarily sets the I/O timeout of the session, given in seconds (None waits forever)
+    @contextmanager
+    def io_timeout(self, seconds):
+        previous = self.device.timeout
+        self.device.timeout = None if seconds is None else max(1, int(seconds * 1000))
+        try:
+            yield
+        finally:
+            self.device.timeout = previous
+
+    # shortest I/O timeout in seconds a polling query gets, well above the round trip time of
+    # the link, so a short poll does not give up on a reply that is merely on its way
+    min_poll_io_timeout = 0.5
+
+    # polls query with exponential backoff until predicate(reply) is true and returns the
+    # reply. Queries timing out (e.g. while the instrument resets) are retried until the
+    # deadline, after which TimeoutError is raised. The late reply of a timed out query is
+    # discarded with the session recovery, so it cannot be read as the reply to a later query
+    def poll_status(self, query, predicate, timeout=None, interval=1e-3, max_interval=0.1):
+        timeout = self.sync_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            with self.transaction():
+                try:
+                    with self.io_timeout(max(remaining, self.min_poll_io_timeout)):
+                        reply = self.query_command(query).strip()
+                    if predicate(reply):
+                        return reply
+                except visa.errors.VisaIOError as error:
+                    if not is_timeout(error):
+                        raise
+                    self.recover_session(error)
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f'{query} did not reach the expected state within {timeout} s')
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+    # returns as soon as all previously sent commands are executed (*OPC? answers 1)
+    def wait_operation_complete(self, timeout=None, check_errors=False):
+        self.poll_status('*OPC?', lambda reply: reply == '1', timeout)
+        if check_errors:
+            self.check_event_status()
+
+    # reads (and thereby clears) *ESR?, logs command, execution, device and query errors
+    def check_event_status(self):
+        esr = int(self.query_command('*ESR?'))
+        self._log_event_status(esr)
+        return esr
+
+    def _log_event_status(self, esr):
+        errors = {self.event_status.COMMAND_ERROR: 'command error',
+                  self.event_status.EXECUTION_ERROR: 'execution error',
+                  self.event_status.DEVICE_ERROR: 'device error',
+                  self.event_status.QUERY_ERROR: 'query error'}
+        for bit, name in errors.items():
+            if esr & bit:
+                self.logger.error(f'Instrument reported a {name} (*ESR? {esr})')
@@ -1,6 +1,8 @@
 from math import floor, log10, pi
+from functools import lru_cache
 import re
 import logging
+import numpy as np
 
 
 def powerise10(x):
@@ -27,35 +29,69 @@ def eng_notation(x):
     return "%.4gE%s" % (a, b)
 
 
-def val_and_unit_to_real_val(val_with_unit='1s'):
-    if isinstance(val_with_unit, float):
-        return val_with_unit
-    elif isinstance(val_with_unit, int):
-        return val_with_unit
-    elif isinstance(val_with_unit, str):
-        number = float(re.search(r"([0-9.]+)", val_with_unit).group(0))
-        unit = re.search(r"([a-zA-Z]+)", val_with_unit).group(0)
-        if (unit == 'MHz'):
-            real_val_no_units = number * 1e6
-        elif (unit == 'kHz'):
-            real_val_no_units = number * 1e3
-        elif (unit == 's' or unit == 'V' or unit == 'Hz'):
-            real_val_no_units = number
-        elif (unit == 'ms' or unit == 'mV' or unit == 'mHz'):
-            real_val_no_units = number * 1e-3
-        elif (unit == 'us' or unit == 'uV'):
-            real_val_no_units = number * 1e-6
-        elif (unit == 'ns' or unit == 'nV'):
-            real_val_no_units = number * 1e-9
-        elif (unit == 'deg'):
-            real_val_no_units = number
-        elif (unit == 'rad'):
-            real_val_no_units = number * 180 / pi
-        else:
-            real_val_no_units = number
-        return real_val_no_units
+# decimal exponent per SI prefix, 'K' is accepted for kilo and 'u', the micro sign and the
+# Greek mu for micro
+SI_PREFIXES = {'Q': 30, 'R': 27, 'Y': 24, 'Z': 21, 'E': 18, 'P': 15, 'T': 12, 'G': 9,
+               'M': 6, 'k': 3, 'K': 3, 'h': 2, 'da': 1, 'd': -1, 'c': -2, 'm': -3,
+               'u': -6, '\u00b5': -6, '\u03bc': -6, 'n': -9, 'p': -12, 'f': -15,
+               'a': -18, 'z': -21, 'y': -24, 'r': -27, 'q': -30}
+
+# units (matched case insensitively) and the factor converting them to the value sent to
+# the instruments, angles are sent in degrees
+SI_UNITS = {'': 1.0, 's': 1.0, 'v': 1.0, 'vpp': 1.0, 'vrms': 1.0, 'vdc': 1.0, 'a': 1.0,
+            'hz': 1.0, 'w': 1.0, 'ohm': 1.0, 'dbm': 1.0, 'db': 1.0, '%': 1.0, 'bps': 1.0,
+            'sa/s': 1.0, 'pts': 1.0, 'div': 1.0, 'deg': 1.0, 'rad': 180 / pi}
+
+_si_value_pattern = re.compile(
+    r'^\s*([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)\s*([a-zA-Z\u00b5\u03bc%/]*)\s*$')
+
+
+@lru_cache(maxsize=4096)
+def parse_si_value(text):
+    """Converts a number with optional SI prefix and unit ('-100mV', '1e-3s', '2 kHz', '1k') to a float.
+
+    Units are case insensitive, the prefix is case sensitive: '1MV' is a megavolt and
+    '1mhz' a millihertz. A whole unit wins over prefix and unit, '1a' is an ampere and
+    '1as' an attosecond. Angles in 'rad' are converted to degrees, the unit the instruments
+    expect ('1rad' gives 57.3). Raises ValueError for text that is not a value with a known unit.
+    """
+    match = _si_value_pattern.match(text)
+    if match is None:
+        raise ValueError(f'Not a value with unit: {text!r}')
+    number, suffix = float(match.group(1)), match.group(2)
+    unit = suffix.lower()
+    if unit in SI_UNITS:
+        return number * SI_UNITS[unit]
+    # a prefix without unit ('1k') is a plain number, 'da' is the only two letter prefix
+    for length in (2, 1):
+        prefix, unit = suffix[:length], suffix[length:].lower()
+        if prefix in SI_PREFIXES and unit in SI_UNITS:
+            break
     else:
-        return val_with_unit
+        raise ValueError(f'Unknown unit {suffix!r} in {text!r}')
+    exponent = SI_PREFIXES[prefix]
+    # dividing by an exact power of ten keeps '10us' at 1e-05 instead of 9.999999999999999e-06
+    scaled = number * 10**exponent if exponent > 0 else number / 10**-exponent
+    return scaled * SI_UNITS[unit]
+
+
+def val_and_unit_to_real_val(val_with_unit='1s'):
+    if isinstance(val_with_unit, str):
+        return parse_si_value(val_with_unit)
+    return val_with_unit
+
+
+def vals_and_units_to_real_vals(vals_with_units, dtype=np.float64):
+    """Converts a list or array of values with units (or numbers) to a numpy array.
+
+    Every distinct string is parsed once, which makes sweep tables of repeated settings cheap.
+    """
+    values = np.asarray(vals_with_units)
+    if values.dtype.kind in 'biuf':
+        return values.astype(dtype)
+    unique, inverse = np.unique(values.astype(str), return_inverse=True)
+    parsed = np.array([parse_si_value(text) for text in unique], dtype=dtype)
+    return parsed[inverse].reshape(values.shape)
 
 
 class CustomLogger(logging.Logger):
@@ -0,0 +1,170 @@
+import inspect
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+import numpy as np
+
+# Thread-safe access to one instrument shared by several threads.
+#
+# An InstrumentSession opens the instrument in a worker thread, which from then on is the
+# only thread touching the VISA handle. Other threads submit whole driver method calls to
+# its request queue and get their result (or exception) back through a Future, so the
+# commands and replies of two callers can never interleave. Requests are served by
+# priority, in FIFO order within the same priority:
+#
+#   session = InstrumentSession(RigolDS1054Z, 'TCPIP::192.168.0.99::INSTR')
+#   session.single_trigger()                              # blocks until done
+#   future = session.submit('get_measurement', 1, _priority=InstrumentSession.priority.HIGH)
+#   session.close()
+#
+# The options of the session itself start with an underscore (_priority, _timeout), every
+# other keyword is passed to the driver method. Generator methods (iter_waveform_chunks)
+# run completely in the worker too, their items are handed over through a queue.
+
+
+# items of generator methods may be views of a buffer the generator reuses for the next
+# item, the consumer gets copies
+def _detached(item):
+    if isinstance(item, np.ndarray):
+        return item.copy()
+    if isinstance(item, tuple):
+        return tuple(_detached(part) for part in item)
+    return item
+
+
+class InstrumentSession:
+
+    class priority:
+        HIGH = 0
+        NORMAL = 1
+        LOW = 2
+
+    # driver is the instrument class (or any callable returning an instrument), it is called
+    # with args and kwargs in the worker thread. Errors while opening are raised here
+    def __init__(self, driver, *args, name=None, **kwargs):
+        self._requests = queue.PriorityQueue()
+        # tie breaker keeping FIFO order within a priority, requests themselves are not comparable
+        self._sequence = itertools.count()
+        self._closed = False
+        self.instrument = None
+        opened = Future()
+        self._worker = threading.Thread(target=self._run, args=(driver, args, kwargs, opened),
+                                        name=name or f'{getattr(driver, "__name__", "instrument")} session',
+                                        daemon=True)
+        self._worker.start()
+        opened.result()
+
+    def _run(self, driver, args, kwargs, opened):
+        try:
+            self.instrument = driver(*args, **kwargs)
+        except BaseException as error:
+            opened.set_exception(error)
+            return
+        opened.set_result(self.instrument)
+        while True:
+            _, _, request = self._requests.get()
+            if request is None:
+                break
+            future, method, args, kwargs = request
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                target = method if callable(method) else getattr(self.instrument, method)
+                future.set_result(target(*args, **kwargs))
+            except BaseException as error:
+                future.set_exception(error)
+
+    # queues a call of the driver method (its name, or a function called in the worker) and
+    # returns a Future of its result
+    def submit(self, method, *args, _priority=priority.NORMAL, **kwargs):
+        if self._closed:
+            raise RuntimeError('Instrument session is closed')
+        future = Future()
+        self._requests.put((_priority, next(self._sequence), (future, method, args, kwargs)))
+        return future
+
+    # queues a call and waits for its result, at most _timeout seconds
+    def call(self, method, *args, _priority=priority.NORMAL, _timeout=None, **kwargs):
+        return self.submit(method, *args, _priority=_priority, **kwargs).result(_timeout)
+
+    # iterates a generator method in the worker and yields its items in the calling thread.
+    # The worker stays busy with the iteration (up to _buffered items ahead of the consumer)
+    # until it ends or the consumer closes the iterator
+    def iterate(self, method, *args, _priority=priority.NORMAL, _buffered=4, **kwargs):
+        items = queue.Queue(_buffered)
+        cancelled = threading.Event()
+        end = object()
+
+        def hand_over(item):
+            while not cancelled.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            generator = getattr(self.instrument, method)(*args, **kwargs)
+            try:
+                for item in generator:
+                    if not hand_over(_detached(item)):
+                        return
+            finally:
+                generator.close()
+            hand_over(end)
+
+        future = self.submit(produce, _priority=_priority)
+        try:
+            while True:
+                try:
+                    item = items.get(timeout=0.1)
+                except queue.Empty:
+                    if future.done() and items.empty():
+                        # raises the error of the generator, if any
+                        future.result()
+                        return
+                    continue
+                if item is end:
+                    return
+                yield item
+        finally:
+            cancelled.set()
+
+    # driver methods called on the session are executed by the worker, other attributes
+    # (constants, measurement definitions) are read from the instrument directly
+    def __getattr__(self, name):
+        if name.startswith('_') or self.__dict__.get('instrument') is None:
+            raise AttributeError(name)
+        attribute = getattr(self.instrument, name)
+        if not callable(attribute) or isinstance(attribute, type):
+            return attribute
+        if inspect.isgeneratorfunction(attribute):
+            def iterate(*args, **kwargs):
+                return self.iterate(name, *args, **kwargs)
+            iterate.__name__ = name
+            return iterate
+
+        def call(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    # serves the requests already queued, then stops the worker. With close_instrument the
+    # instrument is closed by the worker as its last request
+    def close(self, close_instrument=True):
+        if self._closed:
+            return
+        if close_instrument:
+            self.submit('close', _priority=self.priority.LOW)
+        self._closed = True
+        # sorts after every queued request
+        self._requests.put((float('inf'), next(self._sequence), None))
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
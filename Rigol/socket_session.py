@@ -0,0 +1,151 @@
+import re
+import socket
+import pyvisa as visa
+from Rigol.transfer import parse_block_header
+
+# Native raw socket session for TCPIP::<host>::<port>::SOCKET resources (port 5555 on the
+# Rigol instruments), used by the connection pool instead of a pyvisa-py session.
+#
+# It offers the subset of the pyvisa resource interface the drivers use (write, query,
+# read_raw, read_bytes, timeout, close) plus read_into, which lets read_block_into()
+# receive :WAV:DATA? payloads with recv_into straight into the destination array.
+# Timeouts are raised as VisaIOError like on a VISA session.
+
+DEFAULT_PORT = 5555
+# kernel receive buffer requested for bulk transfers, the OS may grant less
+RECEIVE_BUFFER_SIZE = 8 << 20
+# user space buffer for replies read line by line or in small pieces
+READ_BUFFER_SIZE = 1 << 16
+
+_resource_pattern = re.compile(r'^TCPIP\d*::([^:]+)::(\d+)::SOCKET$', re.IGNORECASE)
+
+
+def parse_socket_resource(resource):
+    """Returns (host, port) of a TCPIP::<host>::<port>::SOCKET resource, None for other resources"""
+    match = _resource_pattern.match(resource.strip())
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+class RawSocketSession:
+
+    def __init__(self, host, port=DEFAULT_PORT, timeout=10000, receive_buffer=RECEIVE_BUFFER_SIZE):
+        self.resource_name = f'TCPIP::{host}::{port}::SOCKET'
+        family, kind, protocol, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+        self._socket = socket.socket(family, kind, protocol)
+        # the receive buffer has to be set before connecting, the TCP window scale is
+        # negotiated during the handshake
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket.settimeout(timeout / 1000)
+        try:
+            self._socket.connect(address)
+        except OSError:
+            self._socket.close()
+            raise
+        self._timeout = timeout
+        # bytes received but not consumed yet are buffer[start:end]
+        self._buffer = bytearray(READ_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    @classmethod
+    def from_resource(cls, resource):
+        return cls(*parse_socket_resource(resource))
+
+    # I/O timeout in milliseconds, as on a pyvisa resource
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, milliseconds):
+        self._timeout = milliseconds
+        self._socket.settimeout(milliseconds / 1000 if milliseconds else None)
+
+    def _recv_into(self, view):
+        try:
+            received = self._socket.recv_into(view)
+        except socket.timeout:
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout) from None
+        if received == 0:
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_connection_lost)
+        return received
+
+    def _fill(self):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buffer):
+            # move the unread bytes to the front to make room
+            pending = self._end - self._start
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, pending
+            if pending == len(self._buffer):
+                self._view.release()
+                self._buffer.extend(bytes(len(self._buffer)))
+                self._view = memoryview(self._buffer)
+        self._end += self._recv_into(self._view[self._end:])
+
+    def write(self, message):
+        self._socket.sendall(message.encode() + b'\n')
+
+    # one response, up to and including the terminating newline. Block responses (#N<len>)
+    # are read completely, their payload may contain newlines
+    def read_raw(self):
+        while self._end - self._start < 2:
+            self._fill()
+        if self._buffer[self._start] == ord('#') and chr(self._buffer[self._start + 1]).isdigit():
+            digits = int(chr(self._buffer[self._start + 1]))
+            header = self.read_bytes(2 + digits)
+            length = parse_block_header(header)[1]
+            return header + self.read_bytes(length + 1)
+        # bytes after start already searched for the newline
+        searched = 0
+        while True:
+            newline = self._buffer.find(b'\n', self._start + searched, self._end)
+            if newline >= 0:
+                break
+            searched = self._end - self._start
+            self._fill()
+        data = bytes(self._view[self._start:newline + 1])
+        self._start = newline + 1
+        return data
+
+    def read_bytes(self, count):
+        while self._end - self._start < count:
+            self._fill()
+        data = bytes(self._view[self._start:self._start + count])
+        self._start += count
+        return data
+
+    # fills view completely, buffered bytes first and the rest received straight into it
+    def read_into(self, view):
+        buffered = min(self._end - self._start, len(view))
+        view[:buffered] = self._view[self._start:self._start + buffered]
+        self._start += buffered
+        pos = buffered
+        while pos < len(view):
+            pos += self._recv_into(view[pos:])
+        return pos
+
+    # discards everything received until the instrument stays silent for quiet seconds,
+    # e.g. the rest of a block whose read timed out
+    def clear(self, quiet=0.2):
+        self._start = self._end = 0
+        self._socket.settimeout(quiet)
+        try:
+            while self._socket.recv_into(self._view):
+                pass
+        except socket.timeout:
+            pass
+        finally:
+            self.timeout = self._timeout
+
+    def query(self, message):
+        self.write(message)
+        return self.read_raw().decode()
+
+    def close(self):
+        self._socket.close()
@@ -0,0 +1,251 @@
+import json
+import os
+import numpy as np
+
+# largest piece requested from the device per read call while filling a block
+BLOCK_READ_SIZE = 1 << 20
+
+
+def parse_block_header(header):
+    """Returns (header_length, payload_length) of an IEEE 488.2 '#N<len>' block header"""
+    if len(header) < 2 or header[0:1] != b'#' or not header[1:2].isdigit():
+        raise ValueError(f'Not an IEEE 488.2 block header: {bytes(header[:16])}')
+    digits = int(header[1:2])
+    if digits == 0:
+        raise ValueError('Indefinite length blocks (#0) are not supported')
+    if len(header) < 2 + digits:
+        raise ValueError(f'Truncated IEEE 488.2 block header: {bytes(header)}')
+    return 2 + digits, int(header[2:2 + digits])
+
+
+def read_block_header(device):
+    """Reads a block header from the device and returns the payload length"""
+    header = device.read_bytes(2)
+    if header[0:1] == b'#' and header[1:2].isdigit():
+        header += device.read_bytes(int(header[1:2]))
+    return parse_block_header(header)[1]
+
+
+def _read_payload_into(device, view, length):
+    if hasattr(device, 'read_into'):
+        device.read_into(view[:length])
+    else:
+        pos = 0
+        while pos < length:
+            piece = device.read_bytes(min(BLOCK_READ_SIZE, length - pos))
+            view[pos:pos + len(piece)] = piece
+            pos += len(piece)
+    # consume the message terminator following the block
+    device.read_bytes(1)
+
+
+def read_block_into(device, out):
+    """Reads one definite length block from the device straight into the writable buffer out.
+
+    The payload is copied piece by piece into a memoryview of out, so no intermediate
+    object larger than BLOCK_READ_SIZE is ever allocated. Returns the payload length.
+    """
+    length = read_block_header(device)
+    view = memoryview(out).cast('B')
+    if length > len(view):
+        raise ValueError(
+            f'Block of {length} bytes does not fit into buffer of {len(view)} bytes')
+    _read_payload_into(device, view, length)
+    return length
+
+
+def read_block(device):
+    """Reads one definite length block from the device into a new uint8 array"""
+    length = read_block_header(device)
+    out = np.empty(length, dtype=np.uint8)
+    _read_payload_into(device, memoryview(out), length)
+    return out
+
+
+class transport:
+    USB = 'USB'
+    INSTR = 'INSTR'
+    SOCKET = 'SOCKET'
+
+
+def transport_from_resource(resource):
+    """Returns the transport class of a VISA resource string"""
+    resource = resource.upper()
+    if resource.startswith('USB'):
+        return transport.USB
+    if resource.startswith('TCPIP') and resource.endswith('::SOCKET'):
+        return transport.SOCKET
+    return transport.INSTR
+
+
+# largest number of points the scope returns per :WAV:DATA? read, per waveform format
+# (ascii transfers work with 131072 points instead of the documented 15625)
+MAX_CHUNK_POINTS = {'BYTE': 250000, 'WORD': 125000, 'ASC': 131072}
+
+# first chunk size per transport as a fraction of the format limit, VXI-11 starts lower
+# because pyvisa-py splits large replies into many small RPC reads
+INITIAL_CHUNK_FRACTION = {transport.USB: 1.0, transport.INSTR: 0.25, transport.SOCKET: 1.0}
+
+MIN_CHUNK_POINTS = 1000
+
+
+class TransferPlanner:
+    """Splits the points [first, last] of a :WAV:DATA? transfer into (start, stop) chunks.
+
+    The chunks always cover the range exactly, the last one included. The reader reports
+    the transfer time of every chunk with record(points, seconds) right after reading it,
+    so that whatever the consumer does between two chunks is not counted. The chunk size
+    is doubled as long as this improves the measured throughput by more than 5 % and a
+    chunk is expected to finish within half the I/O timeout. The tuned size is kept in
+    chunk_points and can be handed to the next planner as initial chunk.
+    """
+
+    def __init__(self, last, first=1, fmt='BYTE', transport=transport.INSTR, timeout=None, chunk_points=None):
+        self.first = int(first)
+        self.last = int(last)
+        self.max_points = MAX_CHUNK_POINTS[fmt]
+        self.timeout = timeout
+        if chunk_points is None:
+            chunk_points = self.max_points * INITIAL_CHUNK_FRACTION[transport]
+        self.chunk_points = self._clamp(chunk_points)
+        self.tuned = False
+        self.best_rate = 0.0
+        self.best_points = self.chunk_points
+
+    def _clamp(self, points):
+        return int(min(max(points, MIN_CHUNK_POINTS), self.max_points))
+
+    def __len__(self):
+        return self.last - self.first + 1
+
+    @property
+    def reads(self):
+        # number of reads if the current chunk size is kept, used as progress total
+        return -(-len(self) // self.chunk_points)
+
+    def _balanced(self, remaining):
+        # spread the remainder evenly instead of ending on a tiny chunk
+        reads = -(-remaining // self.chunk_points)
+        return -(-remaining // reads)
+
+    def record(self, points, elapsed):
+        if elapsed <= 0:
+            return
+        if self.timeout and elapsed > 0.5 * self.timeout:
+            self.chunk_points = self.best_points = self._clamp(self.chunk_points // 2)
+            self.tuned = True
+            return
+        if self.tuned or points != self.chunk_points:
+            return
+        rate = points / elapsed
+        if rate > 1.05 * self.best_rate:
+            self.best_rate = rate
+            self.best_points = points
+            grown = self._clamp(points * 2)
+            if grown == points or (self.timeout and 2 * elapsed > 0.5 * self.timeout):
+                self.tuned = True
+            else:
+                self.chunk_points = grown
+        else:
+            self.chunk_points = self.best_points
+            self.tuned = True
+
+    def __iter__(self):
+        start = self.first
+        while start <= self.last:
+            remaining = self.last - start + 1
+            points = self._balanced(remaining) if self.tuned else min(self.chunk_points, remaining)
+            stop = start + points - 1
+            yield start, stop
+            start = stop + 1
+
+
+class TransferProgress:
+    """Completed [start, stop] point ranges of a chunked transfer of the points [first, last]"""
+
+    def __init__(self, last, first=1, ranges=()):
+        self.first = int(first)
+        self.last = int(last)
+        self.ranges = []
+        for start, stop in ranges:
+            self.add(start, stop)
+
+    # records a received chunk, adjacent and overlapping ranges are merged
+    def add(self, start, stop):
+        merged = []
+        for range_start, range_stop in sorted(self.ranges + [(int(start), int(stop))]):
+            if merged and range_start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], range_stop))
+            else:
+                merged.append((range_start, range_stop))
+        self.ranges = merged
+
+    # the [start, stop] ranges still to be transferred
+    def missing(self):
+        gaps = []
+        next_start = self.first
+        for start, stop in self.ranges:
+            if start > next_start:
+                gaps.append((next_start, start - 1))
+            next_start = max(next_start, stop + 1)
+        if next_start <= self.last:
+            gaps.append((next_start, self.last))
+        return gaps
+
+    @property
+    def done(self):
+        return not self.missing()
+
+    @property
+    def received(self):
+        return sum(stop - start + 1 for start, stop in self.ranges)
+
+
+class PartialDownload:
+    """uint8 download buffer backed by a file, whose progress survives the process.
+
+    The points go to an np.memmap at path, the completed ranges and the metadata of the
+    capture (memory depth, channel, preamble) to a JSON sidecar at path + '.json' after
+    every chunk. Opening the same path for the same capture continues where it stopped,
+    a sidecar of a different capture is discarded.
+    """
+
+    def __init__(self, path, length, metadata):
+        self.path = str(path)
+        self.sidecar = self.path + '.json'
+        # as read back from JSON, tuples become lists
+        self.metadata = metadata = json.loads(json.dumps(metadata))
+        ranges = []
+        resume = False
+        if os.path.exists(self.path) and os.path.exists(self.sidecar):
+            with open(self.sidecar) as file:
+                state = json.load(file)
+            resume = state.get('metadata') == metadata and os.path.getsize(self.path) == length
+            ranges = state['ranges'] if resume else []
+        self.buffer = np.memmap(self.path, dtype=np.uint8, mode='r+' if resume else 'w+', shape=(length,))
+        self.progress = TransferProgress(length, ranges=ranges)
+
+    def missing(self):
+        return self.progress.missing()
+
+    def _write_sidecar(self):
+        with open(self.sidecar, 'w') as file:
+            json.dump({'metadata': self.metadata, 'ranges': self.progress.ranges}, file)
+
+    def add(self, start, stop):
+        self.progress.add(start, stop)
+        self.buffer.flush()
+        self._write_sidecar()
+
+    # forgets the received ranges, e.g. when the points turn out to be of another capture
+    def restart(self):
+        self.progress = TransferProgress(self.progress.last, self.progress.first)
+        self._write_sidecar()
+
+    # copies the completed capture into memory and deletes both files
+    def finish(self):
+        data = np.array(self.buffer)
+        del self.buffer
+        os.remove(self.path)
+        os.remove(self.sidecar)
+        return data
@@ -0,0 +1,91 @@
+from typing import NamedTuple
+import numpy as np
+
+# points converted per np.take call, keeps the intp index temporary at 512 kB
+SCALE_CHUNK_POINTS = 1 << 16
+
+
+class WaveformPreamble(NamedTuple):
+    """The 10 fields returned by :WAV:PRE?, describing how to scale :WAV:DATA? points"""
+    format: int  # 0 WORD, 1 BYTE, 2 ASC
+    type: int  # 0 NORM, 1 MAX, 2 RAW
+    points: int
+    count: int
+    x_increment: float
+    x_origin: float
+    x_reference: float
+    y_increment: float
+    y_origin: float
+    y_reference: float
+
+    @classmethod
+    def from_response(cls, response):
+        if isinstance(response, bytes):
+            response = response.decode()
+        fields = response.strip().split(',')
+        if len(fields) != 10:
+            raise ValueError(f'Expected 10 preamble fields, got: {response.strip()}')
+        return cls(*(int(float(f)) for f in fields[:4]), *(float(f) for f in fields[4:]))
+
+
+def scale_lut(preamble, dtype=np.float32):
+    """Returns the 256 entry table holding the voltage of every possible byte value"""
+    codes = np.arange(256, dtype=np.float64)
+    return ((codes - preamble.y_origin - preamble.y_reference) * preamble.y_increment).astype(dtype)
+
+
+def scale_uint8(data, preamble, out=None, dtype=np.float32, lut=None):
+    """Converts uint8 waveform points to volts in a single pass through the lookup table.
+
+    The result is written into out if given (its dtype wins over dtype), otherwise into a
+    new array. No full size temporaries are created.
+    """
+    data = np.asarray(data)
+    if data.dtype != np.uint8:
+        raise TypeError(f'Expected uint8 waveform points, got {data.dtype}')
+    if out is None:
+        out = np.empty(len(data), dtype=dtype)
+    elif len(out) < len(data):
+        raise ValueError(f'Output buffer of {len(out)} points is too small for {len(data)} points')
+    if lut is None:
+        lut = scale_lut(preamble, out.dtype)
+    out = out[:len(data)]
+    for start in range(0, len(data), SCALE_CHUNK_POINTS):
+        stop = start + SCALE_CHUNK_POINTS
+        # every uint8 is a valid index, clip mode skips the bounds check and its copy of out
+        np.take(lut, data[start:stop], out=out[start:stop], mode='clip')
+    return out
+
+
+def iter_scaled(chunks, preamble, dtype=np.float32):
+    """Scales an iterable of uint8 chunks, yielding views into one reused volts buffer"""
+    lut = scale_lut(preamble, dtype)
+    out = np.empty(0, dtype=dtype)
+    for chunk in chunks:
+        if len(out) < len(chunk):
+            out = np.empty(len(chunk), dtype=dtype)
+        yield scale_uint8(chunk, preamble, out=out, lut=lut)
+
+
+def window_indices(preamble, t_start, t_stop):
+    """Returns the 1 based [first, last] point indices covering the times [t_start, t_stop].
+
+    Times are relative to the trigger like x_origin, the indices are clipped to the points
+    of the preamble. Raises ValueError if the window lies outside of the waveform.
+    """
+    if t_stop < t_start:
+        raise ValueError(f'Window ends ({t_stop} s) before it starts ({t_start} s)')
+    first = int(np.floor((t_start - preamble.x_origin) / preamble.x_increment + preamble.x_reference)) + 1
+    last = int(np.ceil((t_stop - preamble.x_origin) / preamble.x_increment + preamble.x_reference)) + 1
+    first, last = max(first, 1), min(last, preamble.points)
+    if first > last:
+        raise ValueError(f'Window {t_start} s to {t_stop} s is outside of the waveform')
+    return first, last
+
+
+def window_preamble(preamble, first, last, stride=1):
+    """Preamble of the points first, first + stride, ... up to last of a waveform"""
+    return preamble._replace(points=len(range(first, last + 1, stride)),
+                             x_origin=preamble.x_origin + (first - 1 - preamble.x_reference) * preamble.x_increment,
+                             x_reference=0.0,
+                             x_increment=preamble.x_increment * stride)
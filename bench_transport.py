@@ -0,0 +1,97 @@
+import socketserver
+import sys
+import threading
+import time
+import numpy as np
+from Rigol.transfer import read_block_into
+from Rigol.socket_session import RawSocketSession
+
+# Throughput of the :WAV:DATA? download over the pyvisa-py SOCKET session against the
+# native raw socket session. Without arguments both talk to a local loopback stand-in
+# serving a random 24 Mpts capture, pass a host to measure the LAN port of a real scope:
+#   python3 bench_transport.py 192.168.0.99
+
+MDEPTH = 24_000_000
+CHUNK = 250_000
+PORT = 5555
+
+
+class StandInScope(socketserver.StreamRequestHandler):
+    # answers :WAV:STAR/:WAV:STOP/:WAV:DATA? like a DS1000Z in RAW BYTE mode
+
+    memory = np.random.default_rng(0).integers(0, 256, MDEPTH, dtype=np.uint8).tobytes()
+
+    def handle(self):
+        start, stop = 1, MDEPTH
+        for line in self.rfile:
+            for command in line.decode().strip().split(';'):
+                header, _, value = command.partition(' ')
+                if header == ':WAV:STAR':
+                    start = int(value)
+                elif header == ':WAV:STOP':
+                    stop = int(value)
+                elif header == ':WAV:DATA?':
+                    payload = memoryview(self.memory)[start - 1:stop]
+                    self.wfile.write(b'#9' + f'{len(payload):09d}'.encode())
+                    self.wfile.write(payload)
+                    self.wfile.write(b'\n')
+                elif header == ':ACQ:MDEP?':
+                    self.wfile.write(f'{MDEPTH}\n'.encode())
+                elif header == '*IDN?':
+                    self.wfile.write(b'RIGOL TECHNOLOGIES,DS1054Z,STAND-IN,00.04.04\n')
+
+
+def start_stand_in():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StandInScope)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+def open_visa(host, port):
+    import pyvisa as visa
+    device = visa.ResourceManager('@py').open_resource(f'TCPIP::{host}::{port}::SOCKET')
+    device.read_termination = '\n'
+    return device
+
+
+def open_raw(host, port):
+    return RawSocketSession(host, port)
+
+
+def download(device, mdepth):
+    buffer = np.zeros(mdepth, dtype=np.uint8)
+    for start in range(1, mdepth + 1, CHUNK):
+        stop = min(start + CHUNK - 1, mdepth)
+        device.write(f':WAV:STAR {start};:WAV:STOP {stop};:WAV:DATA?')
+        read_block_into(device, buffer[start-1:stop])
+    return buffer
+
+
+SESSIONS = {'pyvisa-py SOCKET': open_visa,
+            'RawSocketSession': open_raw}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        host, port = sys.argv[1], PORT
+    else:
+        server, port = start_stand_in()
+        host = '127.0.0.1'
+    print(f'{"session":<20}{"MB/s":>10}{"seconds":>10}')
+    reference = None
+    for name, open_session in SESSIONS.items():
+        device = open_session(host, port)
+        device.timeout = 10000
+        if len(sys.argv) > 1:
+            device.write(':STOP;:WAV:SOUR CHAN1;:WAV:MODE RAW;:WAV:FORM BYTE')
+        mdepth = int(device.query(':ACQ:MDEP?'))
+        t0 = time.perf_counter()
+        data = download(device, mdepth)
+        elapsed = time.perf_counter() - t0
+        device.close()
+        if reference is None:
+            reference = data
+        elif not np.array_equal(reference, data):
+            print(f'{name} returned different data')
+        print(f'{name:<20}{mdepth / elapsed / 1e6:>10.1f}{elapsed:>10.2f}')
@@ -0,0 +1,127 @@
+import multiprocessing
+import sys
+import time
+import tracemalloc
+import numpy as np
+from Rigol.transfer import read_block_into
+
+# Benchmark of the :WAV:DATA? download path, legacy read_raw() slicing against
+# the header parsing read-into engine. Without arguments a simulated scope
+# serves a random 24 Mpts capture, pass a VISA resource to measure a real one:
+#   python3 bench_waveform_download.py TCPIP::192.168.0.99::INSTR
+
+MDEPTH = 24_000_000
+CHUNK = 250_000
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class SimulatedScope:
+    # answers :WAV:STAR/:WAV:STOP/:WAV:DATA? like a DS1000Z in RAW BYTE mode
+
+    def __init__(self, mdepth=MDEPTH):
+        self.memory = np.random.default_rng(0).bytes(mdepth)
+        self.start = 1
+        self.stop = mdepth
+        self.pending = memoryview(b'')
+
+    def write(self, command):
+        header, _, value = command.partition(' ')
+        if header == ':WAV:STAR':
+            self.start = int(value)
+        elif header == ':WAV:STOP':
+            self.stop = int(value)
+        elif header == ':WAV:DATA?':
+            payload = self.memory[self.start - 1:self.stop]
+            self.pending = memoryview(
+                b'#9' + f'{len(payload):09d}'.encode() + payload + b'\n')
+
+    def read_raw(self):
+        data = bytes(self.pending)
+        self.pending = self.pending[len(data):]
+        return data
+
+    def read_bytes(self, count):
+        data = bytes(self.pending[:count])
+        self.pending = self.pending[len(data):]
+        return data
+
+
+def legacy_download(device, mdepth):
+    buffer = np.zeros(mdepth, dtype=np.uint8)
+    for i in range(0, int(mdepth / CHUNK)):
+        start = 1+i*CHUNK
+        stop = (1+i)*CHUNK
+        device.write(f':WAV:STAR {start}')
+        device.write(f':WAV:STOP {stop}')
+        device.write(':WAV:DATA?')
+        fullreading = device.read_raw()
+        array = fullreading[11:-1]
+        datapoints = np.frombuffer(array, dtype=np.uint8)
+        buffer[start-1:stop] = datapoints
+    return buffer
+
+
+def read_into_download(device, mdepth):
+    buffer = np.zeros(mdepth, dtype=np.uint8)
+    for i in range(0, int(mdepth / CHUNK)):
+        start = 1+i*CHUNK
+        stop = (1+i)*CHUNK
+        device.write(f':WAV:STAR {start}')
+        device.write(f':WAV:STOP {stop}')
+        device.write(':WAV:DATA?')
+        read_block_into(device, buffer[start-1:stop])
+    return buffer
+
+
+METHODS = {'legacy read_raw': legacy_download,
+           'read_block_into': read_into_download}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return float('nan')
+    # ru_maxrss is reported in kilobytes on linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+
+
+def open_device(resource_name):
+    if resource_name is None:
+        return SimulatedScope(), MDEPTH
+    import pyvisa as visa
+    device = visa.ResourceManager('@py').open_resource(resource_name)
+    device.timeout = 10000
+    device.write(':STOP')
+    device.write(':WAV:SOUR CHAN1')
+    device.write(':WAV:MODE RAW')
+    device.write(':WAV:FORM BYTE')
+    return device, int(device.query(':ACQ:MDEP?'))
+
+
+def run(name, resource_name, results):
+    device, mdepth = open_device(resource_name)
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    METHODS[name](device, mdepth)
+    elapsed = time.perf_counter() - t0
+    _, peak_alloc = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results.put((name, mdepth / elapsed / 1e6, peak_rss_mb(), peak_alloc / 1e6))
+
+
+if __name__ == '__main__':
+    resource_name = sys.argv[1] if len(sys.argv) > 1 else None
+    # every method runs in its own process so the peak RSS values are independent
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    print(f'{"method":<20}{"MB/s":>10}{"peak RSS [MB]":>16}{"peak alloc [MB]":>18}')
+    for name in METHODS:
+        process = ctx.Process(target=run, args=(name, resource_name, results))
+        process.start()
+        name, rate, peak_rss, peak_alloc = results.get()
+        process.join()
+        print(f'{name:<20}{rate:>10.1f}{peak_rss:>16.1f}{peak_alloc:>18.1f}')
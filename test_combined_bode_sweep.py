@@ -1,9 +1,12 @@
 from math import pi
 import os
+import glob
 import time
 import numpy as np
 from Rigol.DG900 import RigolDG992
 from Rigol.DS1000 import RigolDS1054Z
+from Rigol.waveform import WaveformPreamble
+from Rigol.bode import analyze_sweep
 import matplotlib.pyplot as plt
 import control
 import datetime
@@ -14,7 +17,8 @@ import datetime
 
 DO_MEASUREMENT_CYCLE = True
 PLOT_RESULTS = True
-LOAD_MEASUREMENT_TIMESTAMP = '2022-12-09_15-27-09'
+# capture loaded if DO_MEASUREMENT_CYCLE is False, None loads the latest one saved with preambles
+LOAD_MEASUREMENT_TIMESTAMP = None
 
 
 def init_scope(scope):
@@ -22,11 +26,12 @@ def init_scope(scope):
     scope.print_info()
     scope.reset()
 
-    scope.setup_mem_depth(24E6)
     scope.setup_channel(channel=1, on=1, offset_divs=0,
                         volts_per_div=1.5, probe=1)
     scope.setup_channel(channel=2, on=1, offset_divs=0,
                         volts_per_div=1.5, probe=1)
+    # 24 Mpts are only available with a single channel enabled
+    scope.setup_mem_depth(12E6)
     scope.setup_timebase(time_per_div='1s', delay='5s')
     scope.setup_trigger(channel=1, level='1V')
 
@@ -49,7 +54,23 @@ def load_prev_waveforms(datetime):
     return data_in, data_out
 
 
-def save_waveforms(data_in, data_out):
+def latest_capture_with_preambles():
+    captures = sorted(glob.glob('waveforms/preamble_*.npy'))
+    if not captures:
+        raise SystemExit('No capture with saved preambles in waveforms/, set DO_MEASUREMENT_CYCLE = True')
+    return os.path.basename(captures[-1])[len('preamble_'):-len('.npy')]
+
+
+# older measurements were saved without preamble, they are scaled with the live scope settings
+def load_prev_preambles(datetime):
+    if not os.path.exists(f'waveforms/preamble_{datetime}.npy'):
+        return None, None
+    with open(f'waveforms/preamble_{datetime}.npy', 'rb') as f:
+        preambles = np.load(f)
+    return WaveformPreamble(*preambles[0]), WaveformPreamble(*preambles[1])
+
+
+def save_waveforms(data_in, data_out, preamble_in, preamble_out):
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
     if not os.path.exists('waveforms'):
@@ -59,6 +80,8 @@ def save_waveforms(data_in, data_out):
         np.save(f, data_in)
     with open(f'waveforms/waveform_out_{timestamp}.npy', 'wb') as f:
         np.save(f, data_out)
+    with open(f'waveforms/preamble_{timestamp}.npy', 'wb') as f:
+        np.save(f, np.array([preamble_in, preamble_out]))
 
 
 scope = RigolDS1054Z('TCPIP::192.168.0.99::INSTR',
@@ -74,40 +97,48 @@ if DO_MEASUREMENT_CYCLE:
     time.sleep(2)
     fgen.output_state(1)
     fgen.triggerSweep(1)
-    time.sleep(12)
+    scope.wait_for_acquisition(timeout=15)
 
-    data_in = scope.get_waveform_data_uint8(channel=1)
-    data_out = scope.get_waveform_data_uint8(channel=2)
+    waveforms, preambles = scope.get_waveforms(channels=[1, 2])
+    data_in = waveforms[1]
+    data_out = waveforms[2]
+    preamble_in = preambles[1]
+    preamble_out = preambles[2]
 
-    save_waveforms(data_in, data_out)
+    save_waveforms(data_in, data_out, preamble_in, preamble_out)
 
 else:
-    data_in, data_out = load_prev_waveforms(LOAD_MEASUREMENT_TIMESTAMP)
+    timestamp = LOAD_MEASUREMENT_TIMESTAMP or latest_capture_with_preambles()
+    data_in, data_out = load_prev_waveforms(timestamp)
+    preamble_in, preamble_out = load_prev_preambles(timestamp)
+    if preamble_in is None:
+        preamble_in, preamble_out = scope.get_preamble(1), scope.get_preamble(2)
 
-analog_in = scope.scale_waveform_uint8(data_in)
-analog_out = scope.scale_waveform_uint8(data_out)
+analog_in = scope.scale_waveform_uint8(data_in, preamble_in)
+analog_out = scope.scale_waveform_uint8(data_out, preamble_out)
 
 if (PLOT_RESULTS):
     plt.plot(range(len(analog_out)), analog_out)
     plt.plot(range(len(analog_in)), analog_in)
     plt.show()
 
-# TODO Calculate gain and phase diff
+# CH1 is the excitation (reference), CH2 the DUT output
+bode = analyze_sweep(data_out, data_in, preamble_out, preamble_in)
 
-# R = 1E6
-# C = 100E-9
+R = 1E6
+C = 100E-9
 
-# tf = control.tf([1], [R*C, 1])
-# control.bode(tf, Hz=True, dB=True, deg=True)
+tf = control.tf([1], [R*C, 1])
+control.bode(tf, Hz=True, dB=True, deg=True)
 
-# plt.tight_layout()
+plt.tight_layout()
 
-# ax1, ax2 = plt.gcf().axes     # get subplot axes
+ax1, ax2 = plt.gcf().axes     # get subplot axes
 
-# plt.sca(ax1)                 # magnitude plot
-# plt.plot(freq_set[g < 10], g[g < 10])
+plt.sca(ax1)                 # magnitude plot
+plt.plot(bode.frequency, bode.gain_db)
 
-# plt.sca(ax2)                 # phase plot
-# plt.plot(freq_set[pha < 10E2], pha[pha < 10E2])
+plt.sca(ax2)                 # phase plot
+plt.plot(bode.frequency, bode.phase)
 
-# plt.show()
+plt.show()
@@ -1,5 +1,4 @@
 from Rigol.DS1000 import RigolDS1054Z
-import time
 #import smbus
 
 # rigol_ds1054z class functions were writen to allow the high-level script
@@ -21,9 +20,14 @@ scope.setup_trigger(channel=1, slope_pos=1, level='500mv')
 scope.single_trigger()
 # i2c = smbus.SMBus(1)
 # i2c.write_quick(0x50) #
-time.sleep(3)
-for measurement in scope.single_measurement_list:
-    scope.get_measurement(channel=1, meas_type=measurement)
+try:
+    scope.wait_for_acquisition(timeout=3)
+except TimeoutError:
+    scope.force_trigger()
+# all items of single_measurement_list in one round trip
+measurements = scope.get_measurements(channel=1)
+for name, value in measurements.items():
+    scope.logger.info(f'{name}: {value}')
 # for measurement in scope.single_measurement_list:
 # 	scope.get_measurement(channel=2, meas_type=measurement)
 scope.get_measurement(channel=1, meas_type=scope.max_voltage)